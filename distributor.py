@@ -4,23 +4,35 @@ import logging
 import os
 import shutil
 import subprocess
+import sys
 import tempfile
 import time
 import traceback
-import urllib.parse
-from copy import deepcopy
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import partial
 from pathlib import Path
-from typing import Union
-from uuid import uuid4
+from typing import TYPE_CHECKING, List, Set, Tuple, Union
 
-import requests
 import yaml
 
-from nebula_distributor import HostBuilder, NebulaCerts, NebulaNetworkConfig, NebulaPaths, Passwords, create_installer_archive
-from nebula_distributor.commands import install_cert, install_config, nebula_service_cmd
-from nebula_distributor.ssh import NebulaSSH
-from nebula_distributor.ssh import get_ip_addresses
+# Only what building configs needs is imported here. Connecting to hosts (fabric, paramiko, keyring), pinging,
+# downloading Nebula (requests), building installers and watching files import their modules when they're used, so
+# --generate-only runs start fast.
+from nebula_distributor import HostBuilder, NebulaCerts, NebulaNetworkConfig, NebulaPaths
+from nebula_distributor import commands
+from nebula_distributor.affected import affected_hosts, builder_at, changed_entries, config_changed_hosts, git_changed_files, git_show, relative_to_configs
+from nebula_distributor.certs import parse_cert_time
+from nebula_distributor.commands import build_install_transaction, build_move_into_place, build_readiness_check, build_sha256sum, nebula_service_cmd
+from nebula_distributor.readiness import get_ip_addresses, interface_has_ip, wait_for
+from nebula_distributor.render import config_header, render_configs
+from nebula_distributor.rollout import Rollout, plan_waves
+from nebula_distributor.state import DeployState, content_digest
+from nebula_distributor.metrics import metrics
+from nebula_distributor.tracing import Tracer
+from nebula_distributor.verify import VerifyResult, compare_digests, parse_sha256sum, sha256_digest
+
+if TYPE_CHECKING:
+    from nebula_distributor.ssh import NebulaSSH
 
 script_directory = os.path.abspath(os.path.dirname(__file__))
 config_to_ip = []
@@ -28,9 +40,6 @@ logging.basicConfig(level=logging.CRITICAL)
 logger = logging.getLogger('distributor')
 yaml.Dumper.ignore_aliases = lambda *args: True  # Don't print pointers added when copying dicts
 
-# TODO: get the latest release
-nebula_latest = 'https://github.com/slackhq/nebula/releases/download/v1.6.1/'
-
 parser = argparse.ArgumentParser(description='Nebula Network Distributor: an easy way to distribute configs and certs to your Nebula network.')
 parser.add_argument('--config', default=Path(script_directory, 'config.yml'), help='Path to config.yml if it is not located next to this executable.')
 parser.add_argument('--files', default=Path(script_directory, 'files'), help='Path to the nebula-files directory if it is not located next to this executable.')
@@ -38,45 +47,29 @@ parser.add_argument('--log', default=False, help='Log to this file.')
 parser.add_argument('--restart-type', required=False, default='reload', choices=['reload', 'restart'], help='How to restart the Nebula service on the remote host.')
 parser.add_argument('--verbose', '-v', action='store_true')
 parser.add_argument('--daemon', '-d', action='store_true', help='Start in daemon mode.')
-parser.add_argument('--generate-certs', '-c', action='store_true', help='Generate and install new certs for each host.')
+parser.add_argument('--generate-certs', '-c', action='store_true', help='Install certs on each host, generating new ones for hosts whose name, IP or groups changed, whose cert was signed by another CA or is about to expire.')
 parser.add_argument('--overwrite-pw', action='store_true', help='Don\'t read anything from the keystore and prompt for new passwords.')
-parser.add_argument('--change-ip', default=False, help='Path to a yaml file to change IPs.')
+parser.add_argument('--change-ip', default=False, help='Path to a yaml file to change IPs if it is not change_ip.yml next to config.yml.')
 parser.add_argument('--ping', action='store_true', help='Test connection to each host. Don\'t do anything else.')
 parser.add_argument('--generate-only', '-g', action='store_true', help='Don\'t connect to any remote host or install on local machine. Only generate configs and certs.')
 parser.add_argument('--sfx', '-s', action='store_true', help='Create self-extracting installers to install on the hosts.')
 parser.add_argument('--hosts', default=[], nargs='*', help='Only do these hosts.')
-args = parser.parse_args()
+parser.add_argument('--parallel', '-p', type=int, default=1, help='Deploy to this many hosts at once. Output is grouped per host.')
+parser.add_argument('--canary', type=int, default=None, help='Deploy to this many hosts after the lighthouses before doing the rest. Overrides `rollout.canary` in the config.')
+parser.add_argument('--wave-size', type=int, default=None, help='Deploy the remaining hosts in waves of this size. Overrides `rollout.wave_size` in the config.')
+parser.add_argument('--transaction', '-t', action='store_true', help='Install, test, reload and verify each host with one remote script that puts the old files back if anything fails.')
+parser.add_argument('--incremental', '-i', action='store_true', help='Skip hosts whose config and certs have not changed since they were last deployed.')
+parser.add_argument('--max-failure-ratio', type=float, default=None, help='Abort the remaining waves when more than this share of hosts have failed. Overrides `rollout.max_failure_ratio` in the config.')
+parser.add_argument('--changed-files', default=[], nargs='*', help='Only do the hosts whose config is built from these files (config.yml, change_ip.yml or anything in files/configs).')
+parser.add_argument('--since', default=None, help='Only do the hosts affected by what changed in config.yml and files/configs since this git revision.')
+parser.add_argument('--metrics-port', type=int, default=None, help='Serve Prometheus metrics on this port (needs prometheus_client). Mostly useful with --daemon.')
+parser.add_argument('--report', default=None, help='Append how long each phase took for each host to this JSONL file.')
+args = None
 
 
 # TODO: embed the certs inside the config file???
 
 
-def download_file(url: str, output_path: str):
-    # local_filename = os.path.join(target_dir, url.split('/')[-1])
-    local_filename = output_path
-    # NOTE the stream=True parameter below
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(local_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                # If you have chunk encoded response uncomment if
-                # and set chunk_size parameter to None.
-                # if chunk:
-                f.write(chunk)
-    return local_filename
-
-
-def append_to_start_of_file(file: Union[str, Path], *write_lines):
-    file = open(file, 'r+')
-    lines = file.readlines()
-    file.seek(0)
-    for new in write_lines:
-        file.write(str(new) + '\n')
-    for line in lines:
-        file.write(line)
-    file.close()
-
-
 def get_ssh_port(host):
     if 'ssh' in host and 'port' in host['ssh']:
         return host['ssh']['port']
@@ -93,7 +86,7 @@ def get_ssh_username(host):
         return ''
 
 
-def reload_nebula(restart_type, use_sudo=True):
+def reload_nebula(conn: Union['NebulaSSH', None], restart_type, use_sudo=True) -> bool:
     print(f'{restart_type.capitalize()}ing Nebula service...')
     reload_nebula_cmd = None  # make pycharm happy
     if restart_type == 'reload':
@@ -111,292 +104,607 @@ def reload_nebula(restart_type, use_sudo=True):
         reload = subprocess.run(reload_nebula_cmd, shell=True).returncode
     if reload > 0:
         print('Failed to reload Nebula service, code:', reload)
-    time.sleep(2)  # sleep for a bit so we don't spam the service
-
-
-def bulk_build_config(hosts, base_config, host_base_config, type: str = None):
-    if not args.ping:
-        for hostname, host in hosts.items():
-            created = datetime.now().strftime('%m/%d/%Y %H:%M:%S')
-            host_conf = host_builder.build_config(hostname, deepcopy(base_config), deepcopy(host_base_config), deepcopy(host))
+    return reload == 0
+
+
+def wait_until_ready(conn: Union['NebulaSSH', None], nebula_ip: str) -> bool:
+    """
+    Poll until Nebula is running and its interface has the host's Nebula IP. `conn` is (re)connected as needed.
+    """
+    if not conn:
+        return wait_for(lambda: interface_has_ip(nebula_ip), timeout=config.get('ready_timeout', 30))
+
+    def check():
+        try:
+            if not conn.is_alive() and not conn.connect():
+                return False
+            x = conn.execute(build_readiness_check(nebula_ip), retries=1)
+        except Exception:
+            return False  # the connection may drop while Nebula restarts, or the host isn't up on its new IP yet
+        return bool(x) and x.stdout == 'ready'
+
+    return wait_for(check, timeout=config.get('ready_timeout', 30))
+
+
+def install_files(conn: Union['NebulaSSH', None], files: dict, use_sudo=True, install_cmd=build_move_into_place) -> Tuple[Union[int, None], str]:
+    """
+    Install files (path -> content) on the host. Remote hosts get them over SFTP, the local machine through a temp dir.
+    `install_cmd` builds the command that moves the staged files into place. Returns its exit code, None if it didn't
+    run to the end (the upload failed or the connection dropped), and its stdout.
+    """
+    if conn:
+        x = conn.upload_files(files, use_sudo=use_sudo, print_err=True, install_cmd=lambda tmp, staged: install_cmd(tmp, staged, use_sudo=False))
+        return (x.return_code, x.stdout) if x is not None else (None, '')
+    tmp_dir = tempfile.mkdtemp(prefix='nebula-distributor-')
+    staged = {}
+    for path, content in files.items():
+        staged_path = os.path.join(tmp_dir, os.path.basename(path))
+        with open(os.open(staged_path, os.O_WRONLY | os.O_CREAT, 0o600), 'w') as file:
+            file.write(content)
+        staged[staged_path] = path
+    s = subprocess.run(install_cmd(tmp_dir, staged, use_sudo=use_sudo), shell=True, stdout=subprocess.PIPE, text=True)
+    return s.returncode, s.stdout
+
+
+def verify_installed(conn: Union['NebulaSSH', None], expected: dict, use_sudo=True) -> List[VerifyResult]:
+    """
+    Hash the installed files on the host with one command and compare them to the digests we expect.
+    """
+    if conn:
+        x = conn.execute(build_sha256sum(expected.keys(), use_sudo=False), sudo=use_sudo, print_err=True)
+        output = x.stdout if x else ''
+    else:
+        output = subprocess.check_output(build_sha256sum(expected.keys(), use_sudo=use_sudo), shell=True).decode()
+    return compare_digests(expected, parse_sha256sum(output))
+
+
+def machine_info(hostname, host, type: str = None) -> dict:
+    return {
+        'host': host["nebula_ip"],
+        'port': get_ssh_port(host),
+        'username': get_ssh_username(host),
+        'hostname': hostname,
+        'type': type,
+        'groups': host['groups'],
+        'arch': host.get('arch', 'linux-amd64'),
+        'init': host.get('init', 'systemd'),
+        'skip_connection': host.get('skip_connection', False),
+        'use_sudo': (host['ssh'].get('use_sudo', True) if 'ssh' in host.keys() else True),
+    }
+
+
+def connect_address(machine) -> str:
+    if machine['hostname'] in change_ip_config.keys():
+        return change_ip_config[machine['hostname']]['nebula_ip']
+    return machine['host']
+
+
+def bulk_build_config(hosts: list):
+    """
+    Render and write the configs for a list of (hostname, host, type) items.
+    """
+    created = datetime.now().strftime('%m/%d/%Y %H:%M:%S')
+    # Rendering is spread over processes, so it's timed for all hosts at once.
+    removed_rules = {}
+    with tracer.phase('*', 'render'):
+        for hostname, host, type, config_body, removed in render_configs(host_builder, hosts):
+            removed_rules[hostname] = removed
             out_file = config_output_dir / f'{type + "-" if type is not None else ""}{hostname}.yml'
             with open(out_file, 'w') as file:
-                yaml.safe_dump(host_conf, file, default_flow_style=False)
-            verify_str = f'{uuid4()}-{uuid4()}'
-            append_to_start_of_file(out_file, f'# Nebula hostname: {hostname}', f'# nebula_ip: {host["nebula_ip"]}', f'# Type: {type}', f'# groups: {", ".join(host["groups"])}', f'# Config built: {created}', f'# {verify_str}', '')
+                file.write(config_header(hostname, host, type, created) + config_body)
             config_to_ip.append({
-                'host': host["nebula_ip"],
-                'port': get_ssh_port(host),
-                'username': get_ssh_username(host),
+                **machine_info(hostname, host, type),
                 'config_file': out_file,  # 'config': host_conf,
-                'hostname': hostname,
-                'verify': verify_str,
-                'type': type,
-                'groups': host['groups'],
-                'arch': host.get('arch', 'linux-amd64'),
-                'init': host.get('init', 'systemd'),
-                'skip_connection': host.get('skip_connection', False),
-                'use_sudo': (host['ssh'].get('use_sudo', True) if 'ssh' in host.keys() else True),
+                'config_digest': content_digest(config_body),  # doesn't include the header so the timestamp doesn't count
             })
+    if sum(removed_rules.values()):
+        print(f'Removed {sum(removed_rules.values())} duplicate or redundant firewall rules from {len([x for x in removed_rules.values() if x])} hosts.')
+        if args.verbose:
+            for hostname, removed in removed_rules.items():
+                print(f'{hostname} | {removed} firewall rules removed') if removed else None
+
+
+def sign_certs(machines) -> list:
+    """
+    Sign all the certs that are needed up front, in parallel. With --generate-certs that's every cert whose name, IP or
+    groups changed, that another CA signed or that is about to expire, otherwise only the missing ones.
+    """
+    renew_before = timedelta(days=config['certs'].get('renew_before_days', 30))
+    to_sign = []
+    for machine in machines:
+        machine['new_ip'] = change_ip_config[machine['hostname']]['new_ip'] if machine['hostname'] in change_ip_config.keys() and not args.generate_only else None
+        cert = {'name': machine['hostname'], 'type': machine['type'], 'ip': machine['new_ip'] if machine['new_ip'] else connect_address(machine), 'groups': machine['groups']}
+        host_crt_path, _, host_key_path, _ = certs_builder.read_host_certs(machine['hostname'], machine['type'])
+        if args.generate_certs:
+            if certs_builder.needs_signing(**cert, renew_before=renew_before):
+                to_sign.append(cert)
+        elif not host_crt_path.exists() or not host_key_path.exists():
+            to_sign.append(cert)
+    if not len(to_sign):
+        certs_builder.save_index()
+        return []
+    print(f'Signing {len(to_sign)} certs...')
+    def on_signed(cert, seconds, ok):
+        tracer.record(cert['name'], 'sign', seconds, ok)
+        metrics.cert_signed(ok)
+
+    failed = certs_builder.sign_batch(to_sign, on_signed=on_signed)
+    return [(x['name'], x['ip'], 'Failed to sign cert.') for x in failed]
+
+
+def prepare_machine(machine) -> list:
+    """
+    Read the certs for a host. This happens before connecting to anything so the user has them locally and if the
+    connection fails he can install them manually.
+    """
+    failed = []
+    try:
+        host_crt_path, host_crt, host_key_path, host_key = certs_builder.read_host_certs(machine['hostname'], machine['type'])
+        machine['host_crt'] = host_crt
+        machine['host_key'] = host_key
+        machine['certs_digest'] = content_digest(ca_crt, host_crt, host_key)
+        if metrics.enabled:
+            info = certs_builder.cert_info(machine['hostname'], machine['type'])
+            if info:
+                metrics.cert_expires(machine['hostname'], parse_cert_time(info['not_after']).timestamp())
+    except Exception as e:
+        print('EXCEPTION:', e)
+        print(traceback.format_exc())
+        failed.append((machine['hostname'], machine['host'], e))
+    return failed
 
 
-def download_nebula(arch):
-    print(arch)
-    url = f'{nebula_latest}/nebula-{arch}.tar.gz'
-    tmp_file = str(tempfile.mkstemp()[1])
-    tmp_dir = Path(tempfile.mkdtemp())
-    download_file(urllib.parse.urljoin(url, urllib.parse.urlparse(url).path.replace('//', '/')), tmp_file)
-    subprocess.run(f'tar -xzf "{tmp_file}" -C "{tmp_dir}"', shell=True)
-    os.remove(tmp_file)
-    return tmp_dir
-
-
-log_level = logging.INFO if args.verbose else logging.CRITICAL
-
-logger.setLevel(log_level)
-
-args.config = Path(args.config).expanduser().absolute().resolve()
-args.files = Path(args.files).expanduser().absolute().resolve()
-nebula_paths = NebulaPaths(args.files)
-config = NebulaNetworkConfig(args.config).config
-
-if len(args.hosts) == 0:
-    hosts = config['hosts']
-    lighthouses = config['lighthouses']
-else:
-    hosts = {}
-    lighthouses = {}
-    for host in args.hosts:
-        if host in config['hosts'].keys():
-            hosts.update({host: config['hosts'][host]})
-        elif host in config['lighthouses'].keys():
-            lighthouses.update({host: config['lighthouses'][host]})
-
-config_output_dir = Path(config['config_output_dir']).expanduser().absolute().resolve()
-config_output_dir.mkdir(parents=True, exist_ok=True)
-sfx_output_dir = Path(config['sfx_output_dir']).expanduser().absolute().resolve()
-sfx_output_dir.mkdir(parents=True, exist_ok=True)
-
-host_builder = HostBuilder(nebula_paths)
-certs_builder = NebulaCerts(
-    ca_cert=config['certs']['ca_cert'],
-    ca_key=config['certs']['ca_key'],
-    out_dir=Path(config['certs']['output_dir']).expanduser().absolute().resolve(),
-    subnet_size=config['subnet_prefix_size'],
-)
-ca_cert_path, ca_crt = certs_builder.read_ca_crt()
-
-print('Building configs...')
-# Build hosts
-bulk_build_config(hosts, host_builder.base, host_builder.host_base, type='host')
-
-# Build lighthouses
-bulk_build_config(lighthouses, host_builder.base, host_builder.lighthouse_base, type='lighthouse')
-
-# Create a local known_hosts file
-# known_hosts_file = (args.files / 'known_hosts')
-# known_hosts_file.touch()
-
-failed_connections = []
-
-sudo_passwords = Passwords()
-usernames = []
-if config['ssh']['ask_sudo']:
-    for machine in config_to_ip:
-        if machine['username'] not in usernames:
-            pw = sudo_passwords.get(machine['username'])
-            if pw is None or args.overwrite_pw:
-                print('sudo password not saved for username:', machine['username'])
-                sudo_passwords.prompt(machine['username'])
-            else:
-                print('Retrieved sudo password for username:', machine['username'])
-            usernames.append(machine['username'])
-
-change_ip_file = Path('change_ip.yml')
-change_ip_config = {}
-if change_ip_file.exists():
-    with open(change_ip_file, 'r') as file:
-        change_ip_config = yaml.safe_load(file)
-
-nebula_arches = {}
-if args.sfx:
-    print('Downloading Nebula...')
-
-    #    conf_arch_to_nebula_releases = {
-    #        'armv7': nebula_armv7,
-    #        'amd64': nebula_amd64,
-    #        'mips':
-    #    }
-
-    # Check for other arches
-    arches = []
-    for machine in config_to_ip:
-        if machine.get('arch'):
-            # arch_resolved = conf_arch_to_nebula_releases[machine.get('arch')]
-            arches.append(machine.get('arch'))
-            #           if not nebula_arches.get(arch_resolved):
-            #               nebula_arches[arch_resolved] = {
-            #                   'hosts': [machine['hostname']],
-            #                   'path': None,
-            #               }
-            #           else:
-            if machine.get('arch') not in nebula_arches.keys():
-                nebula_arches[machine.get('arch')] = {}
-            if 'hosts' not in nebula_arches[machine.get('arch')].keys():
-                nebula_arches[machine.get('arch')]['hosts'] = []
-            nebula_arches[machine.get('arch')]['hosts'].append(machine['hostname'])
-
-    for arch in arches:
-        if not nebula_arches.get(arch).get('path'):
-            if arch != 'none':
-                nebula_arches[arch]['path'] = download_nebula(arch)  # print(nebula_arches)  # import sys  # sys.exit()
-            else:
-                nebula_arches[arch]['path'] = None
-
-# Upload the files
-for machine in config_to_ip:
+def deploy_machine(machine) -> list:
+    failed = []
     print('\n=================================')
-    new_ip = None
     conn = None  # make pycharm happy
-    local_machine = False
-    nebula_ip = machine['host']
+    new_ip = machine['new_ip']
+    nebula_ip = connect_address(machine)
+    host_crt, host_key = machine['host_crt'], machine['host_key']
 
     print(machine['hostname'], nebula_ip)
+    print('Changing IP to', new_ip) if new_ip is not None else None
+    print()
 
     try:
+        # Skip local machine
+        if nebula_ip in local_addresses:
+            print(nebula_ip, 'is us! :)')
+            conn = None
+        else:
+            conn = ssh_pool.get(host=nebula_ip, username=machine['username'], port=machine['port'], sudo_password=sudo_passwords.get(machine['username']))
+            if conn.is_alive():
+                print('Reusing connection to', nebula_ip)
+            else:
+                # The pre-flight check already made sure the SSH port is open.
+                print('Connecting to', nebula_ip)
+                with tracer.phase(machine['hostname'], 'connect') as span:
+                    if not conn.connect():
+                        print('Failed to connect to', nebula_ip)
+                        failed.append((machine['hostname'], nebula_ip, 'Could not create connection.'))
+                        span['ok'] = False
+                        return failed
+                    print('Connected to host:', conn.execute('hostname', print_err=True).stdout.strip())
+
+        # Only install the certs if asked to, the ones on the host may have been put there by hand.
+        files = {commands.config_path: Path(machine['config_file']).read_text()}
+        if args.generate_certs:
+            files.update({commands.ca_crt_path: ca_crt, commands.host_crt_path: host_crt, commands.host_key_path: host_key})
+        print('Installing config and certs...' if args.generate_certs else 'Installing config...')
+        if args.transaction:
+            # The transaction reloads Nebula and prints the digests of the installed files itself.
+            install_cmd = partial(build_install_transaction, restart_type='restart' if new_ip else args.restart_type)
+        else:
+            install_cmd = build_move_into_place
+        with tracer.phase(machine['hostname'], 'install') as span:
+            exit_code, output = install_files(conn, files, use_sudo=machine['use_sudo'], install_cmd=install_cmd)
+            span['ok'] = installed = exit_code == 0
+        if not installed:
+            print('Failed for host', nebula_ip)
+            restored = args.transaction and exit_code == commands.restored_exit_code
+            failed.append((machine['hostname'], nebula_ip, 'Install transaction failed, previous files restored.' if restored else 'Install failed.'))
+            return failed
+
+        expected = {path: sha256_digest(content) for path, content in files.items()}
+        with tracer.phase(machine['hostname'], 'verify') as span:
+            if args.transaction:
+                verified = compare_digests(expected, parse_sha256sum(output))
+            else:
+                verified = verify_installed(conn, expected, use_sudo=machine['use_sudo'])
+            mismatched = [x for x in verified if not x.ok]
+            span['ok'] = not len(mismatched)
+        if len(mismatched):
+            for x in mismatched:
+                print('FAILED TO VERIFY', x.path, '| expected:', x.expected, '| found:', x.actual if x.actual else 'missing')
+            failed.append((machine['hostname'], nebula_ip, f'Failed to verify {", ".join(x.path for x in mismatched)}.'))
+        else:
+            print('Installed files verified.')
+
+        if not args.transaction:
+            with tracer.phase(machine['hostname'], 'reload') as span:
+                span['ok'] = reload_nebula(conn, 'restart' if new_ip else args.restart_type, use_sudo=machine['use_sudo'])
+        if new_ip and conn is not None:
+            # The restart moved the host to its new IP, which ends the session on the old one.
+            ssh_pool.discard(conn)
+            conn = ssh_pool.get(host=new_ip, username=machine['username'], port=machine['port'], sudo_password=sudo_passwords.get(machine['username']))
+        print('Waiting for Nebula to come back up...')
+        with tracer.phase(machine['hostname'], 'ready') as span:
+            span['ok'] = ready = wait_until_ready(conn, new_ip if new_ip else machine['host'])
+        if not ready:
+            print('Nebula did not come back up on', nebula_ip)
+            failed.append((machine['hostname'], nebula_ip, 'Nebula did not come back up.'))
+        if not len(failed):
+            # Without --generate-certs only the config was installed, the certs on the host are whatever they were.
+            deploy_state.set(machine['hostname'], machine['config_digest'], machine['certs_digest'] if args.generate_certs else None)
+    except Exception as e:
+        print('EXCEPTION:', e)
+        print(traceback.format_exc())
+        failed.append((machine['hostname'], nebula_ip, e))
+    finally:
+        ssh_pool.release(conn) if conn is not None else None
+    metrics.deploy(machine['hostname'], not len(failed))
+    return failed
+
+
+def print_phases():
+    print('\nPhases:')
+    for name, x in tracer.summary().items():
+        print(f'{name} | {x["count"]} | {x["failed"]} failed | p50 {x["p50"]:.2f}s | p95 {x["p95"]:.2f}s | max {x["max"]:.2f}s | total {x["total"]:.1f}s')
+    slowest = tracer.slowest()
+    if len(slowest):
+        print('\nSlowest:')
+        for x in slowest:
+            print(f'{x["host"]} | {x["phase"]} | {x["seconds"]:.2f}s')
+
+
+def print_failed(failed):
+    print('\nFailed:')
+    if len(failed):
+        for x, y, z in failed:
+            print(f'{x} | {y} | {z}')
+    else:
+        print('none!')
 
-        if not args.generate_only:
-            if machine['hostname'] in change_ip_config.keys():
-                new_ip = change_ip_config[machine['hostname']]['new_ip']
-                nebula_ip = change_ip_config[machine['hostname']]['nebula_ip']
 
-            print('Changing IP to', new_ip) if new_ip is not None else None
-            print()
+def load_config():
+    """
+    Load config.yml and change_ip.yml. In daemon mode this runs again every time something changes.
+    """
+    global config, hosts, lighthouses, change_ip_config, local_addresses, config_output_dir, sfx_output_dir, certs_builder, release_cache
+    config = NebulaNetworkConfig(args.config).config
 
-        # Generate the keys before connecting so the user has them locally and if the connection fails he can install them manually.
-        host_crt_path, host_crt, host_key_path, host_key = certs_builder.read_host_certs(machine['hostname'], machine['type'])
-        if (args.generate_certs or not host_crt_path.exists() or not host_key_path.exists()) and not args.ping:
-            print('Generating new cert...')
-            certs_builder.create_new(name=machine['hostname'], ip=nebula_ip if not new_ip else new_ip, groups=machine['groups'], type=machine['type'], overwrite=True)
-
-        if args.sfx:
-            for k, v in nebula_arches.items():
-                for x in v['hosts']:
-                    if x == machine['hostname']:
-                        print(f'Creating self-extracting installer for {k}...')
-                        create_installer_archive(machine['hostname'], sfx_output_dir, machine['config_file'], host_key_path, host_crt_path, ca_cert_path, v['path'], init_type=machine['init'])
-
-        if not args.generate_only:
+    if len(args.hosts) == 0:
+        hosts = config['hosts']
+        lighthouses = config['lighthouses']
+    else:
+        hosts = {}
+        lighthouses = {}
+        for host in args.hosts:
+            if host in config['hosts'].keys():
+                hosts.update({host: config['hosts'][host]})
+            elif host in config['lighthouses'].keys():
+                lighthouses.update({host: config['lighthouses'][host]})
+
+    change_ip_config = {}
+    if change_ip_file.exists():
+        with open(change_ip_file, 'r') as file:
+            change_ip_config = yaml.safe_load(file)
+
+    local_addresses = get_ip_addresses() if not args.generate_only else []
+
+    config_output_dir = Path(config['config_output_dir']).expanduser().absolute().resolve()
+    sfx_output_dir = Path(config['sfx_output_dir']).expanduser().absolute().resolve()
+
+    certs_builder = NebulaCerts(
+        ca_cert=config['certs']['ca_cert'],
+        ca_key=config['certs']['ca_key'],
+        out_dir=Path(config['certs']['output_dir']).expanduser().absolute().resolve(),
+        subnet_size=config['subnet_prefix_size'],
+    )
+
+    release_cache = None
+    if args.sfx:
+        from nebula_distributor.cache import ReleaseCache, nebula_releases
+        # TODO: get the latest release
+        release_cache = ReleaseCache(config.get('nebula_version', 'v1.6.1'), root=config.get('cache_dir', '~/.cache/nebula-distributor'), mirror=config.get('nebula_mirror', nebula_releases))
+
+
+def setup_connections():
+    """
+    Create the SSH pool and the sudo password broker. Runs that don't connect to anything never call this, so they
+    don't import fabric, paramiko and keyring.
+    """
+    global ssh_pool, sudo_passwords
+    from nebula_distributor.passwords import CredentialBroker
+    from nebula_distributor.pool import SSHPool
+    if ssh_pool is None:
+        # Created once so the daemon keeps its connections between runs.
+        ssh_pool = SSHPool(timeout=config['ssh']['timeout'], keepalive=config['ssh'].get('keepalive', 30), max_idle=config['ssh'].get('max_idle', 300))
+    if sudo_passwords is None:
+        # Created once so passwords are only looked up once, daemon cycles included.
+        sudo_passwords = CredentialBroker()
+
+
+def host_items() -> list:
+    return [(hostname, host, 'host') for hostname, host in hosts.items()] + [(hostname, host, 'lighthouse') for hostname, host in lighthouses.items()]
+
+
+def ping():
+    from nebula_distributor.reachability import sweep
+    machines = [machine_info(*x) for x in host_items()]
+    targets = {m['hostname']: (connect_address(m), m['port']) for m in machines if not m['skip_connection'] and connect_address(m) not in local_addresses}
+    results = sweep(targets.values(), timeout=config['ssh']['timeout'])
+    failed_connections = []
+    for hostname, target in targets.items():
+        result = results[target]
+        if result.up:
+            print(f'{hostname} | {target[0]}:{target[1]} | up | {result.latency * 1000:.0f}ms')
+        else:
+            print(f'{hostname} | {target[0]}:{target[1]} | down | {result.error}')
+            failed_connections.append((hostname, target[0], f'Port {target[1]} down.'))
+    print_failed(failed_connections)
+
+
+def ask_sudo_passwords(machines):
+    """
+    Get the sudo password of every username up front, prompting for the ones that aren't saved if `ssh.ask_sudo` is
+    set. The deploy workers then only do dict lookups and the daemon doesn't ask again.
+    """
+    sudo_passwords.prefetch((m['username'] for m in machines), ask=config['ssh']['ask_sudo'], overwrite=args.overwrite_pw)
+
+
+def download_arches(machines) -> dict:
+    """
+    The installer payload for each arch the machines use. Arch `none` installs only the config and certs.
+    """
+    print('Downloading Nebula...')
+    payloads, errors = release_cache.prefetch(m['arch'] for m in machines if m['arch'] != 'none')
+    for arch, error in errors.items():
+        print(f'Failed to get Nebula for {arch}:', error)
+    if any(m['arch'] == 'none' for m in machines):
+        payloads['none'] = None
+    return payloads
+
+
+def build_sfx(machines) -> list:
+    """
+    Build the self-extracting installers for all the machines at once, spread over all the cores.
+    """
+    from nebula_distributor.sfx import build_installers
+    print(f'Creating {len(machines)} self-extracting installers...')
+    start = time.time()
+    failed = [(m['hostname'], m['host'], f'Failed to get Nebula for {m["arch"]}.') for m in machines if m['arch'] not in arch_payloads]
+    machines = [m for m in machines if m['arch'] in arch_payloads]
+    jobs = [{
+        'hostname': m['hostname'],
+        'output': sfx_output_dir,
+        'config': Path(m['config_file']).read_text(),
+        'host_key': m['host_key'],
+        'host_crt': m['host_crt'],
+        'ca_crt': ca_crt,
+        'payload': arch_payloads[m['arch']],
+        'init_type': m['init'],
+        'arch': m['arch'],
+    } for m in machines]
+    hosts_by_name = {m['hostname']: m['host'] for m in machines}
+    arches = {}  # arch -> [hosts, bytes, seconds]
+    for job, size, seconds, error in build_installers(jobs):
+        tracer.record(job['hostname'], 'sfx', seconds, ok=error is None, error=error)
+        if error:
+            print(f'Failed to create the installer for {job["hostname"]}:', error)
+            failed.append((job['hostname'], hosts_by_name[job['hostname']], 'Failed to create installer.'))
+            continue
+        totals = arches.setdefault(job['arch'], [0, 0, 0])
+        totals[0] += 1
+        totals[1] += size
+        totals[2] += seconds
+    print(f'\nInstallers ({time.time() - start:.1f}s):')
+    for arch, (count, size, seconds) in sorted(arches.items()):
+        print(f'{arch} | {count} hosts | {size / 1e6:.1f} MB | {seconds:.1f}s')
+    return failed
+
+
+def targeted_hosts() -> Set[str]:
+    """
+    The hosts affected by the files given with --changed-files and by everything that changed since --since.
+    """
+    global host_builder
+    host_builder = HostBuilder(nebula_paths)
+    builders = [host_builder]
+    changed = [Path(x).expanduser().absolute().resolve() for x in args.changed_files]
+    affected = set()
+    if args.config in changed:
+        # Without the old version there's no telling which entries changed.
+        affected |= set(hosts.keys()) | set(lighthouses.keys())
+    if change_ip_file in changed:
+        affected |= set(change_ip_config.keys())
+
+    if args.since:
+        try:
+            changed += git_changed_files(nebula_paths.configs, args.since)
+        except subprocess.CalledProcessError as e:
+            print(f'Failed to get the files changed since {args.since}:', e.stderr.strip())
+            sys.exit(1)
+        old_config = git_show(args.config, args.since)
+        affected |= config_changed_hosts(yaml.safe_load(old_config) if old_config else None, config)
+        tmp_dir = tempfile.mkdtemp(prefix='nebula-distributor-')
+        try:
+            # The configs as they were, so files that were deleted or no longer apply to a group count too.
+            builders.append(builder_at(nebula_paths, args.since, tmp_dir))
+        except (subprocess.CalledProcessError, OSError, KeyError) as e:
+            print(f'Could not load the configs from {args.since}, only comparing against the current ones:', e)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    affected |= affected_hosts(builders, host_items(), relative_to_configs(nebula_paths, changed))
+    print(f'{len(affected)} hosts affected by the changes:', ', '.join(sorted(affected)) if len(affected) else 'none')
+    return affected
+
+
+def run_once(incremental=False, only: Set[str] = None):
+    """
+    Build everything and roll it out. `incremental` skips unchanged hosts like --incremental does and `only`
+    limits it to these hostnames.
+    """
+    global config_to_ip, host_builder, arch_payloads, deploy_state, ca_cert_path, ca_crt, tracer
+    tracer = Tracer(on_record=metrics.phase)
+    config_output_dir.mkdir(parents=True, exist_ok=True)
+    sfx_output_dir.mkdir(parents=True, exist_ok=True)
+    ca_cert_path, ca_crt = certs_builder.read_ca_crt()
+
+    if host_builder is None:
+        host_builder = HostBuilder(nebula_paths)
+    config_to_ip = []
+    print('Building configs...')
+    bulk_build_config([x for x in host_items() if only is None or x[0] in only])
+
+    # Create a local known_hosts file
+    # known_hosts_file = (args.files / 'known_hosts')
+    # known_hosts_file.touch()
+
+    if not args.generate_only:
+        setup_connections()
+        ask_sudo_passwords(config_to_ip)
+
+    arch_payloads = download_arches(config_to_ip) if args.sfx else {}
+
+    failed_connections = sign_certs(config_to_ip)
+    for machine in config_to_ip:
+        failed_connections.extend(prepare_machine(machine))
+    failed_hosts = {x[0] for x in failed_connections}
+    config_to_ip = [m for m in config_to_ip if m['hostname'] not in failed_hosts]
+    if args.sfx:
+        failed_connections.extend(build_sfx(config_to_ip))
+
+    if args.generate_only:
+        config_to_ip = []
+    else:
+        for machine in config_to_ip:
             if machine['skip_connection']:
-                print('Skipping connecting...')
-                continue
+                print('Skipping connecting to', machine['hostname'])
+        config_to_ip = [m for m in config_to_ip if not m['skip_connection']]
+
+        deploy_state = DeployState(config.get('state_file', config_output_dir / '.deploy-state.json'))
+        if incremental or args.incremental:
+            unchanged = {m['hostname'] for m in config_to_ip if deploy_state.unchanged(m['hostname'], m['config_digest'], m['certs_digest'] if args.generate_certs else None)}
+            print(f'Skipping {len(unchanged)} hosts that are unchanged since the last deploy.')
+            metrics.skipped_unchanged(len(unchanged))
+            config_to_ip = [m for m in config_to_ip if m['hostname'] not in unchanged]
+
+        from nebula_distributor.reachability import sweep
+        # Check every host at once so the rollout doesn't wait on hosts that are down.
+        print('Checking which hosts are up...')
+        targets = {m['hostname']: (connect_address(m), m['port']) for m in config_to_ip if connect_address(m) not in local_addresses}
+        results = sweep(targets.values(), timeout=config['ssh']['timeout'])
+        for hostname, target in targets.items():
+            tracer.record(hostname, 'probe', results[target].seconds, ok=results[target].up, error=results[target].error)
+            if not results[target].up:
+                print('Host', target[0], f'is down on port {target[1]}.')
+                failed_connections.append((hostname, target[0], f'Port {target[1]} down.'))
+        config_to_ip = [m for m in config_to_ip if m['hostname'] not in targets or results[targets[m['hostname']]].up]
+
+    # Upload the files
+    rollout_config = config.get('rollout') or {}
+    waves = plan_waves(
+        config_to_ip,
+        canary=args.canary if args.canary is not None else rollout_config.get('canary', 0),
+        wave_size=args.wave_size if args.wave_size is not None else rollout_config.get('wave_size', 0),
+    )
+    rollout = Rollout(deploy_machine, parallel=args.parallel)
+    try:
+        failed_connections += rollout.run_waves(waves, max_failure_ratio=args.max_failure_ratio if args.max_failure_ratio is not None else rollout_config.get('max_failure_ratio', 1.0))
+    finally:
+        deploy_state.save() if not args.generate_only else None
+        ssh_pool.close_all() if ssh_pool is not None and not args.daemon else None
 
-            # Skip local machine
-            if nebula_ip in get_ip_addresses():
-                print(nebula_ip, 'is us! :)')
-                local_machine = True
-                conn = None
-            else:
-                print('Connecting to', nebula_ip)
-                local_machine = False
-                conn = NebulaSSH(host=nebula_ip, username=machine['username'], port=machine['port'],  # known_hosts_file=known_hosts_file,
-                                 timeout=config['ssh']['timeout'], sudo_password=sudo_passwords.get(machine['username']), )
-                if not conn.check_host_up():
-                    print('Host', nebula_ip, 'is down on port 22.')
-                    failed_connections.append((machine['hostname'], nebula_ip, 'Port 22 down.'))
-                    continue
-                conn.connect()
-                if not conn:
-                    print('Failed to connect to', nebula_ip)
-                    failed_connections.append((machine['hostname'], nebula_ip, 'Could not create connection.'))
-                    continue
-                print('Connected to host:', conn.execute('hostname', print_err=True).stdout.strip())
-            if args.ping:
+    print('\n=================================')
+    print('\nDone!' if not rollout.aborted else '\nAborted!')
+
+    print('\nWaves:')
+    for name, count, seconds, failed in rollout.wave_times:
+        print(f'{name} | {count} hosts | {failed} failed | {seconds:.1f}s')
+
+    print_phases()
+
+    print_failed(failed_connections)
+    if args.report:
+        tracer.write_report(args.report)
+
+
+def run_daemon():
+    """
+    Deploy, then watch config.yml, change_ip.yml and the nebula-files configs and redeploy whenever they change. After
+    a change only the hosts built from the changed files are rebuilt, and of those only the ones whose rendered config
+    or certs changed are deployed to.
+    """
+    global host_builder
+    from nebula_distributor.watcher import Watcher
+    daemon_config = config.get('daemon') or {}
+    watcher = Watcher([args.config, change_ip_file, nebula_paths.configs], debounce=daemon_config.get('debounce', 2), interval=daemon_config.get('poll_interval', 2))
+    run_once(incremental=True)
+    while True:
+        print('\nWatching for changes...')
+        changed = watcher.wait(timeout=config['ssh'].get('max_idle', 300))
+        if not len(changed):
+            ssh_pool.evict_idle() if ssh_pool is not None else None
+            continue
+        print('\nChanged:', ', '.join(str(x) for x in sorted(changed)))
+        try:
+            old_builder, old_config, old_change_ip = host_builder, config, change_ip_config
+            load_config()
+            builders = [old_builder]
+            if any(nebula_paths.configs in x.parents for x in changed):
+                host_builder = HostBuilder(nebula_paths)  # the old one's templates were built from the old files
+                builders.append(host_builder)
+            # Compare with the old builder too so hosts that a deleted file used to apply to are redeployed.
+            only = config_changed_hosts(old_config, config) | changed_entries(old_change_ip, change_ip_config) | affected_hosts(builders, host_items(), relative_to_configs(nebula_paths, changed))
+            if not len(only):
+                print('No hosts affected.')
                 continue
+            print(f'{len(only)} hosts affected:', ', '.join(sorted(only)))
+            run_once(incremental=True, only=only)
+        except Exception as e:
+            # Keep watching, the next change may fix it.
+            print('EXCEPTION:', e)
+            print(traceback.format_exc())
+
+
+host_builder = None
+ssh_pool = None
+sudo_passwords = None
+deploy_state = None
+arch_payloads = {}
+tracer = Tracer(on_record=metrics.phase)
+
+
+def main():
+    global args, nebula_paths, change_ip_file
+    args = parser.parse_args()
+    logger.setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+
+    args.config = Path(args.config).expanduser().absolute().resolve()
+    args.files = Path(args.files).expanduser().absolute().resolve()
+    nebula_paths = NebulaPaths(args.files)
+    change_ip_file = Path(args.change_ip).expanduser().absolute().resolve() if args.change_ip else args.config.parent / 'change_ip.yml'
+    load_config()
+
+    if args.ping:
+        ping()
+        return
+
+    if args.metrics_port:
+        metrics.start(args.metrics_port)
+
+    if args.daemon:
+        try:
+            run_daemon()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            ssh_pool.close_all() if ssh_pool is not None else None
+    else:
+        run_once(only=targeted_hosts() if args.since or len(args.changed_files) else None)
 
-            print('Installing config...')
-            config_file = Path(machine['config_file']).read_text()
-            cmd_install = install_config(config_file, use_sudo=machine['use_sudo'])
-            # print(cmd_install)
-            if conn:
-                if machine['use_sudo']:
-                    config_install = conn.sudo(cmd_install, print_err=True)
-                else:
-                    config_install = conn.execute(cmd_install, print_err=True)
-                if not config_install or config_install.return_code:
-                    print('Failed for host', nebula_ip)
-                    failed_connections.append((machine['hostname'], nebula_ip, 'Config install failed.'))
-                    continue
-            else:
-                subprocess.run(cmd_install, shell=True)
-
-            # TODO: check hash instead of the value
-            cmd_verify = 'cat /etc/nebula/config.yaml'
-            if conn:
-                verify = conn.execute(cmd_verify, print_err=True).stdout
-            else:
-                verify = subprocess.check_output(cmd_verify, shell=True).decode()
-            if machine['verify'] not in verify:
-                print('FAILED TO VERFIY INSTALLED CONFIG! String not found!')
-                failed_connections.append((machine['hostname'], nebula_ip, 'Failed to verify config.'))
-            else:
-                print('Config installed and verified.')
 
-        if args.generate_certs:
-            # print('Generating new cert...')
-            # certs_builder.create_new(name=machine['hostname'], ip=nebula_ip if not new_ip else new_ip, groups=machine['groups'], type=machine['type'], overwrite=True)
-            if not args.generate_only:
-                print('Installing new cert...')
-                cert_install_cmd = install_cert(ca_crt, host_crt, host_key, use_sudo=machine['use_sudo'])
-                if conn:
-                    fail = False
-                    for cmd in cert_install_cmd:
-                        x = conn.execute(cmd, sudo=machine['use_sudo'], print_err=True)
-                        if not x or x.return_code:
-                            print('Failed for host', nebula_ip)
-                            print('Failed on cmd:', cmd)
-                            failed_connections.append((machine['hostname'], nebula_ip, 'Failed to install config.'))
-                            fail = True
-                            break
-                    if fail:
-                        continue
-                else:
-                    fail = False
-                    for action in cert_install_cmd:
-                        s = subprocess.run(action, shell=True)
-                        if s.returncode:
-                            print('Failed on command:', action)
-                            print('stdout:', s.stdout)
-                            print('stderr:', s.stderr)
-                            failed_connections.append((machine['hostname'], nebula_ip, 'Local subprocess command failed.'))
-                            fail = True
-                            break
-                    if fail:
-                        continue
-
-        if not args.ping and not args.generate_only:
-            reload_nebula('restart' if new_ip else args.restart_type, use_sudo=machine['use_sudo'])
-            if local_machine:
-                # TODO: watch interfaces for an ip matching this machine's nebula IP in the config
-                print('Waiting 10s to let link come back up...')
-                time.sleep(10)
-        conn.close() if conn is not None else None
-    except Exception as e:
-        print('EXCEPTION:', e)
-        print(traceback.format_exc())
-        failed_connections.append((machine['hostname'], nebula_ip, e))
-
-print('\n=================================')
-print('\nDone!')
-
-print('\nFailed:')
-if len(failed_connections):
-    for x, y, z in failed_connections:
-        print(f'{x} | {y} | {z}')
-else:
-    print('none!')
-
-if args.sfx:
-    for k, v in nebula_arches.items():
-        if v['path']:
-            shutil.rmtree(v['path'])
+if __name__ == '__main__':
+    main()
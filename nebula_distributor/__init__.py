@@ -1,6 +1,27 @@
-from .certs import NebulaCerts
-from .config_builder import HostBuilder
-from .host_config import NebulaNetworkConfig
-from .nebula_paths import NebulaPaths
-from .passwords import Passwords
-from .sfx import create_installer_archive
\ No newline at end of file
+import importlib
+
+# The names below are imported from their modules on first use (PEP 562), so `from nebula_distributor import
+# HostBuilder` doesn't also import keyring for Passwords.
+lazy_names = {
+    'CredentialBroker': 'passwords',
+    'NebulaCerts': 'certs',
+    'HostBuilder': 'config_builder',
+    'NebulaNetworkConfig': 'host_config',
+    'NebulaPaths': 'nebula_paths',
+    'Passwords': 'passwords',
+    'create_installer_archive': 'sfx',
+}
+
+__all__ = list(lazy_names)
+
+
+def __getattr__(name):
+    if name in lazy_names:
+        value = getattr(importlib.import_module(f'.{lazy_names[name]}', __name__), name)
+        globals()[name] = value  # later lookups don't come through here
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
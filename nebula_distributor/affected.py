@@ -0,0 +1,81 @@
+import io
+import subprocess
+import tarfile
+from pathlib import Path
+from typing import Iterable, List, Set, Tuple, Union
+
+from .config_builder import HostBuilder
+from .nebula_paths import NebulaPaths
+
+
+def changed_entries(old: Union[dict, None], new: Union[dict, None]) -> Set[str]:
+    """
+    Keys that were added or whose value changed between two versions of a dict. Removed keys aren't included.
+    """
+    old = old or {}
+    return {k for k, v in (new or {}).items() if old.get(k) != v}
+
+
+def config_changed_hosts(old_config: Union[dict, None], new_config: dict) -> Set[str]:
+    """
+    Hosts and lighthouses whose entry in config.yml was added or changed.
+    """
+    old_config = old_config or {}
+    return changed_entries(old_config.get('hosts'), new_config.get('hosts')) | changed_entries(old_config.get('lighthouses'), new_config.get('lighthouses'))
+
+
+def relative_to_configs(paths: NebulaPaths, files: Iterable[Union[str, Path]]) -> Set[Path]:
+    """
+    The files that are inside the configs directory, relative to it. Anything else doesn't go into a host's config.
+    """
+    root = paths.configs.absolute()
+    return {Path(x).absolute().relative_to(root) for x in files if root in Path(x).absolute().parents}
+
+
+def affected_hosts(builders: Iterable[HostBuilder], hosts: List[Tuple[str, dict, str]], changed: Set[Path]) -> Set[str]:
+    """
+    Hostnames of the (hostname, host, type) items built from any of the `changed` files (relative to the configs
+    directory). Pass a builder for before and after the change so files that were deleted or no longer apply to a
+    group count too.
+    """
+    affected = set()
+    for builder in builders:
+        root = builder.paths.configs
+        for hostname, host, type in hosts:
+            if hostname not in affected and any(x.relative_to(root) in changed for x in builder.sources(host, type)):
+                affected.add(hostname)
+    return affected
+
+
+def git_changed_files(directory: Union[str, Path], rev: str) -> List[Path]:
+    """
+    Files under `directory` that differ from `rev`, including uncommitted and untracked ones.
+    """
+    def git(*args) -> str:
+        return subprocess.run(['git', '-C', str(directory), *args], capture_output=True, text=True, check=True).stdout
+
+    top = Path(git('rev-parse', '--show-toplevel').strip())
+    names = git('diff', '--name-only', rev, '--', '.').splitlines() + git('ls-files', '--others', '--exclude-standard', '--full-name', '--', '.').splitlines()
+    return [top / x for x in names if x]
+
+
+def git_show(path: Union[str, Path], rev: str) -> Union[str, None]:
+    """
+    The content of a file at `rev`, or None if it didn't exist then.
+    """
+    path = Path(path)
+    s = subprocess.run(['git', '-C', str(path.parent), 'show', f'{rev}:./{path.name}'], capture_output=True, text=True)
+    return s.stdout if s.returncode == 0 else None
+
+
+def builder_at(paths: NebulaPaths, rev: str, out_dir: Union[str, Path]) -> HostBuilder:
+    """
+    A HostBuilder for the configs directory as it was at `rev`, extracted into `out_dir`.
+    """
+    archive = subprocess.run(['git', '-C', str(paths.configs), 'archive', '--format=tar', rev, '--', '.'], capture_output=True, check=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(Path(out_dir, 'configs'))
+    old_paths = NebulaPaths(out_dir)
+    for x in (old_paths.firewalls, old_paths.extras, old_paths.overrides):
+        x.path.mkdir(parents=True, exist_ok=True)  # git doesn't keep empty directories
+    return HostBuilder(old_paths)
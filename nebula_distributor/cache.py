@@ -0,0 +1,168 @@
+import gzip
+import hashlib
+import os
+import shutil
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Tuple, Union
+
+from .sfx import tar_member
+
+nebula_releases = 'https://github.com/slackhq/nebula/releases/download/'
+
+
+def file_sha256(path: Union[str, Path]) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def parse_shasums(text: str) -> Dict[str, str]:
+    """
+    Parse a release's SHASUM256.txt into filename -> digest.
+    """
+    sums = {}
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            sums[parts[1].lstrip('*')] = parts[0].lower()
+    return sums
+
+
+class ReleaseCache:
+    """
+    Nebula release tarballs and the binary payloads built from them, kept between runs under `root/<version>/`.
+    Tarballs are checked against the release's SHASUM256.txt whenever they're used. `mirror` is a URL or a local
+    directory laid out like the GitHub releases: `<mirror>/<version>/nebula-<arch>.tar.gz`.
+    """
+
+    def __init__(self, version: str, root: Union[str, Path] = '~/.cache/nebula-distributor', mirror: str = nebula_releases, timeout: float = 30, workers: int = 4):
+        self.version = version
+        self.dir = Path(root).expanduser() / version
+        self.timeout = timeout
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.session_lock = threading.Lock()
+        self.session = None
+        self.shasums = None
+        self.mirror_dir = None
+        if mirror.startswith('file://'):
+            mirror = mirror[len('file://'):]
+        if '://' in mirror:
+            self.url = mirror.rstrip('/') + '/' + version + '/'
+        else:
+            self.mirror_dir = Path(mirror).expanduser() / version
+
+    def http(self):
+        """
+        The HTTP session, created on first use so runs that find everything in the cache never import requests.
+        """
+        with self.session_lock:
+            if self.session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                self.session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers, max_retries=3)
+                self.session.mount('http://', adapter)
+                self.session.mount('https://', adapter)
+        return self.session
+
+    def download(self, name: str, path: Path) -> bool:
+        """
+        Fetch a file from the mirror into `path`. An HTTP download is kept in `<path>.part` until it finishes so an
+        interrupted one is resumed with a Range request next time. Returns whether it was resumed.
+        """
+        part = path.with_name(path.name + '.part')
+        if self.mirror_dir is not None:
+            shutil.copyfile(self.mirror_dir / name, part)
+            part.replace(path)
+            return False
+
+        offset = part.stat().st_size if part.exists() else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        with self.http().get(self.url + name, stream=True, timeout=self.timeout, headers=headers) as r:
+            if r.status_code == 416:  # the part file already has everything, the checksum will tell
+                part.replace(path)
+                return True
+            r.raise_for_status()
+            resumed = r.status_code == 206
+            with open(part, 'ab' if resumed else 'wb') as f:
+                for chunk in r.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+        part.replace(path)
+        return resumed
+
+    def checksums(self) -> Dict[str, str]:
+        with self.lock:
+            if self.shasums is None:
+                path = self.dir / 'SHASUM256.txt'
+                if not path.exists():
+                    self.dir.mkdir(parents=True, exist_ok=True)
+                    self.download('SHASUM256.txt', path)
+                self.shasums = parse_shasums(path.read_text())
+        return self.shasums
+
+    def tarball(self, arch: str) -> Path:
+        """
+        The release tarball for an arch, downloaded if it isn't cached or doesn't match its checksum.
+        """
+        name = f'nebula-{arch}.tar.gz'
+        expected = self.checksums().get(name)
+        if expected is None:
+            raise KeyError(f'{name} is not in the checksums of Nebula {self.version}')
+        path = self.dir / name
+        if path.exists() and file_sha256(path) == expected:
+            return path
+        print(f'Downloading Nebula {self.version} for {arch}...')
+        if self.download(name, path) and file_sha256(path) != expected:
+            print(f'Resumed download of {name} is corrupt, downloading it again...')
+            path.unlink()
+            self.download(name, path)
+        actual = file_sha256(path)
+        if actual != expected:
+            path.unlink()
+            raise ValueError(f'Checksum mismatch for {name}: expected {expected}, got {actual}')
+        return path
+
+    def payload(self, arch: str, keep_nebula_cert: bool = False) -> Path:
+        """
+        The Nebula binaries for an arch as one gzip member holding a tar stream without the end-of-archive blocks,
+        so an installer is this followed by a gzip member with the host's files (and the end of the archive).
+        """
+        tarball = self.tarball(arch)
+        path = self.dir / f'payload-{arch}{"-with-cert" if keep_nebula_cert else ""}.gz'
+        digest_path = path.with_name(path.name + '.source')
+        digest = file_sha256(tarball)
+        if path.exists() and digest_path.exists() and digest_path.read_text() == digest:
+            return path
+
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with tarfile.open(tarball, 'r:gz') as release, open(tmp, 'wb') as out:
+            with gzip.GzipFile(fileobj=out, mode='wb', mtime=0) as gz:
+                for member in release:
+                    name = Path(member.name).name
+                    if not member.isfile() or (name == 'nebula-cert' and not keep_nebula_cert):
+                        continue
+                    gz.write(tar_member(f'nebula/{name}', release.extractfile(member).read(), mode=0o755, mtime=member.mtime))
+        tmp.replace(path)
+        digest_path.write_text(digest)
+        return path
+
+    def prefetch(self, arches: Iterable[str]) -> Tuple[Dict[str, Path], Dict[str, str]]:
+        """
+        Get the payloads for several arches at once. Returns arch -> payload and arch -> error for the ones that failed.
+        """
+        arches = sorted(set(arches))
+        payloads, errors = {}, {}
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(arches)))) as pool:
+            futures = {arch: pool.submit(self.payload, arch) for arch in arches}
+            for arch, future in futures.items():
+                try:
+                    payloads[arch] = future.result()
+                except Exception as e:
+                    errors[arch] = f'{type(e).__name__}: {e}'
+        return payloads, errors
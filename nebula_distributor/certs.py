@@ -1,7 +1,14 @@
+import hashlib
+import json
 import os
+import re
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Union, Tuple
+from typing import Callable, List, Union, Tuple
 
 
 class NebulaCerts:
@@ -20,11 +27,22 @@ class NebulaCerts:
         assert self.ca_key.exists()
         assert self.out_dir.exists()
 
-    def create_new(self, name: str, type: str, ip: str, groups: Union[list, str] = list, overwrite: bool = False) -> Tuple[Path, Path]:
+        # What we know about each cert we've signed so we don't have to run `nebula-cert print` on it every time.
+        self.index_path = self.out_dir / 'index.json'
+        self.index = {}
+        self.index_lock = threading.Lock()
+        self.ca_info = None  # (sha256 of ca.crt, its info)
+        if self.index_path.exists():
+            with open(self.index_path, 'r') as file:
+                self.index = json.load(file)
+
+    def create_new(self, name: str, type: str, ip: str, groups: Union[list, str] = None, overwrite: bool = False) -> Tuple[Path, Path]:
+        if groups is None:
+            groups = []
         if isinstance(groups, str):
             groups = [groups]
         if len(groups) > 0:
-            groups_arg = f'-groups {" ".join(groups)}'
+            groups_arg = f'-groups "{",".join(groups)}"'
         else:
             groups_arg = ''
         out_cert = self.out_dir / f'{type}-{name}.crt'
@@ -49,3 +67,112 @@ class NebulaCerts:
     def read_file(self, file_path: Union[str, Path]):
         file_path = Path(file_path)
         return None if not file_path.exists() else file_path.read_text()
+
+    def read_cert_info(self, crt: Union[str, Path]) -> Union[dict, None]:
+        """
+        Parse a cert with `nebula-cert print -json`.
+        """
+        s = subprocess.run([str(self.nebula_exe_path), 'print', '-json', '-path', str(crt)], capture_output=True, text=True)
+        if s.returncode:
+            return None
+        try:
+            info = json.loads(s.stdout)
+        except ValueError:
+            return None
+        if isinstance(info, list):  # newer versions print a list of certs
+            info = info[0]
+        details = info['details']
+        return {
+            'fingerprint': info.get('fingerprint'),
+            'name': details['name'],
+            'ips': details['ips'],
+            'groups': details['groups'],
+            'not_after': details['notAfter'],
+            'issuer': details.get('issuer'),  # the fingerprint of the CA that signed it, empty for the CA itself
+        }
+
+    def ca_fingerprint(self) -> Union[str, None]:
+        """
+        The fingerprint of the current CA cert, parsed again whenever ca.crt changes.
+        """
+        ca_sha256 = hashlib.sha256(self.ca_cert.read_bytes()).hexdigest()
+        if self.ca_info is None or self.ca_info[0] != ca_sha256:
+            self.ca_info = (ca_sha256, self.read_cert_info(self.ca_cert))
+        return self.ca_info[1]['fingerprint'] if self.ca_info[1] else None
+
+    def cert_info(self, name: str, type: str) -> Union[dict, None]:
+        """
+        Get the indexed info for a host's cert, parsing it again if the cert changed on disk since it was indexed.
+        """
+        crt = self.out_dir / f'{type}-{name}.crt'
+        if not crt.exists():
+            return None
+        crt_sha256 = hashlib.sha256(crt.read_bytes()).hexdigest()
+        key = f'{type}-{name}'
+        with self.index_lock:
+            entry = self.index.get(key)
+        # Entries indexed before the issuer was kept are parsed again.
+        if entry is None or entry.get('crt_sha256') != crt_sha256 or 'issuer' not in entry:
+            entry = self.read_cert_info(crt)
+            if entry is None:
+                return None
+            entry['crt_sha256'] = crt_sha256
+            with self.index_lock:
+                self.index[key] = entry
+        return entry
+
+    def needs_signing(self, name: str, type: str, ip: str, groups: Union[list, str] = None, renew_before: timedelta = timedelta(days=30)) -> bool:
+        """
+        Whether a host's cert is missing, doesn't match its name, IP or groups, wasn't signed by the current CA (like
+        after replacing the CA) or expires within `renew_before`.
+        """
+        if groups is None:
+            groups = []
+        if isinstance(groups, str):
+            groups = [groups]
+        if not (self.out_dir / f'{type}-{name}.key').exists():
+            return True
+        info = self.cert_info(name, type)
+        if info is None:
+            return True
+        if info['name'] != name or info['ips'] != [f'{ip}/{self.subnet_size}'] or sorted(info['groups']) != sorted(groups):
+            return True
+        ca_fingerprint = self.ca_fingerprint()
+        if ca_fingerprint is not None and info['issuer'] != ca_fingerprint:
+            return True
+        return parse_cert_time(info['not_after']) - renew_before < datetime.now(timezone.utc)
+
+    def sign_batch(self, certs: List[dict], workers: int = None, on_signed: Callable[[dict, float, bool], None] = None) -> List[dict]:
+        """
+        Sign many certs at once. `certs` are dicts of `create_new()` arguments. Each `nebula-cert` runs in its own
+        process so a thread pool is enough to keep them all running in parallel. Returns the ones that failed.
+        `on_signed` is called with each cert, how long it took and whether it worked.
+        """
+
+        def sign(cert):
+            start = time.perf_counter()
+            out_cert, out_key = self.create_new(**cert, overwrite=True)
+            ok = out_cert.exists() and out_key.exists() and self.cert_info(cert['name'], cert['type']) is not None
+            if on_signed:
+                on_signed(cert, time.perf_counter() - start, ok)
+            return None if ok else cert
+
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            failed = [x for x in pool.map(sign, certs) if x is not None]
+        self.save_index()
+        return failed
+
+    def save_index(self):
+        with self.index_lock:
+            tmp = self.index_path.with_suffix('.tmp')
+            with open(tmp, 'w') as file:
+                json.dump(self.index, file, indent=2, sort_keys=True)
+            tmp.replace(self.index_path)
+
+
+def parse_cert_time(value: str) -> datetime:
+    """
+    Parse the RFC 3339 times `nebula-cert print -json` outputs. Go adds nanoseconds which datetime can't handle.
+    """
+    value = re.sub(r'(\.\d+)', '', value).replace('Z', '+00:00')
+    return datetime.fromisoformat(value)
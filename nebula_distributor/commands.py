@@ -1,24 +1,112 @@
-from typing import Tuple, Union
+import shlex
+from pathlib import PurePosixPath
+from typing import Dict, Iterable, List, Tuple, Union
 
 import yaml
 
+config_path = '/etc/nebula/config.yaml'
+ca_crt_path = '/etc/nebula/ca.crt'
+host_crt_path = '/etc/nebula/host.crt'
+host_key_path = '/etc/nebula/host.key'
+
+# What the install transaction exits with when it put the previous files back.
+restored_exit_code = 3
+
 
 def build_file_write(content, file, use_sudo=True) -> str:
     return f"""echo '''{content.strip()}''' | {"sudo" if use_sudo else ""} tee {file} > /dev/null"""
 
 
+def build_install_steps(files: Dict[str, str]) -> List[str]:
+    """
+    Shell steps that copy staged files (staged path -> destination) next to their destination and then rename them over
+    it so Nebula never sees a half-written file.
+    """
+    parents = {str(PurePosixPath(dest).parent) for dest in files.values()}
+    steps = [f'mkdir -p {" ".join(shlex.quote(x) for x in sorted(parents))}']
+    for staged, dest in files.items():
+        dest = PurePosixPath(dest)
+        tmp_dest = dest.parent / f'.{dest.name}.new'
+        steps.append(f'cp {shlex.quote(staged)} {shlex.quote(str(tmp_dest))}')
+        steps.append(f'chmod {"600" if dest.suffix == ".key" else "644"} {shlex.quote(str(tmp_dest))}')
+        steps.append(f'mv -f {shlex.quote(str(tmp_dest))} {shlex.quote(str(dest))}')
+    return steps
+
+
+def build_move_into_place(tmp_dir: str, files: Dict[str, str], use_sudo=True) -> str:
+    """
+    Move staged files (staged path -> destination) into place. The staging dir is always removed.
+    """
+    script = f'( {" && ".join(build_install_steps(files))} ); s=$?; rm -rf {shlex.quote(tmp_dir)}; exit $s'
+    return f'{"sudo" if use_sudo else ""} sh -c {shlex.quote(script)}'
+
+
+def build_install_transaction(tmp_dir: str, files: Dict[str, str], restart_type: str = 'reload', use_sudo=True) -> str:
+    """
+    One script that backs up the files being replaced, moves the staged files into place, tests the config, reloads
+    Nebula and checks that it is still running. If any step fails the backup is put back, Nebula is restarted and the
+    script exits with `restored_exit_code`. Everything the steps print goes to stderr, stdout only gets the sha256sum
+    of the installed files.
+    """
+    dests = [PurePosixPath(x) for x in files.values()]
+    backups = ' '.join(f'{shlex.quote(str(x))}:{x.name}' for x in dests)
+    script = '\n'.join([
+        'exec 3>&1 1>&2',
+        f'TMP={shlex.quote(tmp_dir)}',
+        'BACKUP=$(mktemp -d)',
+        'cleanup() { rm -rf "$TMP" "$BACKUP"; }',
+        'restore() {',
+        '  echo "$1, restoring the previous files..."',
+        '  r=0',
+        f'  for x in {backups}; do',
+        '    if [ -e "$BACKUP/${x#*:}" ]; then cp -p "$BACKUP/${x#*:}" "${x%:*}" || r=1; else rm -f "${x%:*}" || r=1; fi',
+        '  done',
+        f'  {nebula_service_cmd("restart", use_sudo=False).strip()}',
+        '  cleanup',
+        '  [ $r = 0 ] || { echo "Failed to restore the previous files."; exit 1; }',
+        f'  exit {restored_exit_code}',
+        '}',
+        f'for x in {backups}; do',
+        '  if [ -e "${x%:*}" ]; then cp -p "${x%:*}" "$BACKUP/${x#*:}" || { echo "Backup failed."; cleanup; exit 1; }; fi',
+        'done',
+        f'( {" && ".join(build_install_steps(files))} ) || restore "Install failed"',
+        'NEBULA=$(command -v nebula || echo /usr/sbin/nebula)',
+        f'if [ -x "$NEBULA" ]; then "$NEBULA" -test -config {shlex.quote(config_path)} || restore "Config test failed"; fi',
+        f'{nebula_service_cmd(restart_type, use_sudo=False).strip()} || restore "Nebula {restart_type} failed"',
+        'for i in 1 2 3 4 5; do pidof nebula > /dev/null && break; sleep 1; done',
+        'pidof nebula > /dev/null || restore "Nebula is not running"',
+        f'sha256sum {" ".join(shlex.quote(str(x)) for x in dests)} >&3',
+        'cleanup',
+    ])
+    return f'{"sudo" if use_sudo else ""} sh -c {shlex.quote(script)}'
+
+
+def build_sha256sum(files: Iterable[str], use_sudo=True) -> str:
+    # Always exit 0 so a missing file shows up as a missing digest instead of a failed (and retried) command.
+    return f'{"sudo" if use_sudo else ""} sha256sum {" ".join(files)} 2>/dev/null || true'
+
+
+def build_readiness_check(nebula_ip: str) -> str:
+    """
+    Prints "ready" when Nebula is running and its interface has our Nebula IP, "waiting" otherwise. Always exits 0.
+    """
+    ip = nebula_ip.replace('.', '\\.')
+    addr = f'(ip -4 addr show 2>/dev/null || ifconfig 2>/dev/null) | grep -q -e "inet {ip}/" -e "inet {ip} " -e "inet addr:{ip} "'
+    return f'pidof nebula > /dev/null && {addr} && echo ready || echo waiting'
+
+
 def install_cert(ca_crt, host_crt, host_key, use_sudo=True) -> Tuple[str, str, str]:
     return (
-        build_file_write(ca_crt, '/etc/nebula/ca.crt', use_sudo),
-        build_file_write(host_crt, '/etc/nebula/host.crt', use_sudo),
-        build_file_write(host_key, '/etc/nebula/host.key', use_sudo),
+        build_file_write(ca_crt, ca_crt_path, use_sudo),
+        build_file_write(host_crt, host_crt_path, use_sudo),
+        build_file_write(host_key, host_key_path, use_sudo),
     )
 
 
 def install_config(config: Union[dict, str], use_sudo=True) -> str:
     if isinstance(config, dict):
         config = yaml.dump(config, default_flow_style=False)
-    return build_file_write(config, '/etc/nebula/config.yaml', use_sudo)
+    return build_file_write(config, config_path, use_sudo)
 
 
 def nebula_service_cmd(action, use_sudo=True):
@@ -1,7 +1,12 @@
+from copy import deepcopy
+from pathlib import Path
+from typing import Set, Tuple
+
 import sentinel
 import yaml
 from mergedeep import merge, Strategy  # https://mergedeep.readthedocs.io/en/latest/
 
+from .firewall import compact_rules
 from .nebula_paths import NebulaPaths
 
 
@@ -22,14 +27,25 @@ class HostBuilder:
         self.host_base = self.__load_stub(self.paths.base_configs.host_base)
         self.lighthouse_base = self.__load_stub(self.paths.base_configs.lighthouse_base)
 
+        # Which files each host's config is built from, so a change to a file can be traced to the hosts it affects.
+        self.firewall_files = {}  # group -> files with rules for it
+        self.extra_files = {}  # group -> files with extras for it
+        self.override_paths = {}  # override name -> file
+
+        self.firewalls = {}
         for file in self.paths.firewalls.path.iterdir():
-            self.firewalls = merge(self.__load_stub(file), self.firewalls)
+            conf = self.__load_stub(file)
+            for g in (conf or {}).keys():  # before merging, merge() adds the groups of the other files to conf
+                self.firewall_files.setdefault(g, []).append(file)
+            self.firewalls = merge(conf, self.firewalls)
 
         self.extras = {}
+        extra_paths = {}
         for file in self.paths.extras.path.iterdir():
             conf = self.__load_stub(file)
             if conf:  # don't load an empty file
                 self.extras[file.stem] = conf
+                extra_paths[file.stem] = file
 
         self.override_files = {}
         self.overrides = []
@@ -38,24 +54,63 @@ class HostBuilder:
             if conf:
                 self.override_files[file.stem] = conf
                 self.overrides.append(conf)
+                self.override_paths[file.stem] = file
+
+        # Which extras and firewall rules apply to each group, so building a config doesn't have to scan all of them.
+        self.group_extras = {}
+        for name, extra in self.extras.items():
+            if 'groups' not in extra:
+                raise KeyError(f'Missing `groups` key in extra: {extra}')
+            for g in extra['groups']:
+                self.group_extras.setdefault(g, []).append(extra['extra'])
+                self.extra_files.setdefault(g, []).append(extra_paths[name])
+
+        # Hosts with the same groups and overrides get the same config, so it's only built once.
+        self.templates = {}
+
+    def sources(self, host: dict, type: str) -> Set[Path]:
+        """
+        The files that contribute to the config of a host of this type (`host` or `lighthouse`).
+        """
+        files = {self.paths.base_configs.base, self.paths.base_configs.lighthouse_base if type == 'lighthouse' else self.paths.base_configs.host_base}
+        for g in host['groups']:
+            files.update(self.extra_files.get(g, []))
+            files.update(self.firewall_files.get(g, []))
+        for o in host.get('overrides') or []:
+            if o in self.override_paths:
+                files.add(self.override_paths[o])
+        return files
 
     def build_config(self, hostname: str, base_config: dict, host_base_config: dict, host: dict) -> dict:
         """
-        Build a config for a host.
+        Build a config for a host. The base configs aren't modified. Hosts with the same groups and overrides share
+        the nested parts of the returned dict, so don't modify it.
         """
+        return dict(self.__template(base_config, host_base_config, host)[2])
 
+    def removed_rules(self, base_config: dict, host_base_config: dict, host: dict) -> int:
+        """
+        How many firewall rules were dropped from the host's config as duplicates or already allowed by other rules.
+        """
+        return self.__template(base_config, host_base_config, host)[3]
+
+    def __template(self, base_config: dict, host_base_config: dict, host: dict) -> tuple:
+        key = (id(base_config), id(host_base_config), tuple(host['groups']), tuple(host.get('overrides') or ()))
+        template = self.templates.get(key)
+        # Keep references to the base configs so their ids can't be reused by other dicts.
+        if template is None or template[0] is not base_config or template[1] is not host_base_config:
+            template = (base_config, host_base_config, *self.__build_template(base_config, host_base_config, host))
+            self.templates[key] = template
+        return template
+
+    def __build_template(self, base_config: dict, host_base_config: dict, host: dict) -> Tuple[dict, int]:
         groups = host['groups']
         # Use the base config as a starting point for the dict
-        conf = merge(base_config, host_base_config)
+        conf = merge(deepcopy(base_config), host_base_config)
 
-        extras_to_apply = {}
-        for g in host['groups']:
-            for name, extra in self.extras.items():
-                if 'groups' in extra:
-                    if g in extra['groups']:
-                        conf = merge(conf, extra['extra'], strategy=Strategy.ADDITIVE)
-                else:
-                    raise KeyError(f'Missing `groups` key in extra: {extra}')
+        for g in groups:
+            for extra in self.group_extras.get(g, []):
+                conf = merge(conf, extra, strategy=Strategy.ADDITIVE)
 
         for g in groups:
             if g in self.firewalls.keys():
@@ -71,8 +126,15 @@ class HostBuilder:
                     conf = merge(conf, self.override_files[o])
 
         if conf.get('preferred_ranges'):
-            conf['preferred_ranges'] = list(set(conf['preferred_ranges']))
-        return dict(conf)
+            conf['preferred_ranges'] = list(dict.fromkeys(conf['preferred_ranges']))  # keeps the order, so the config is the same every run
+
+        # Every group adds its own rules, so there are usually duplicates and rules that another one already covers.
+        removed = 0
+        for direction in ('inbound', 'outbound'):
+            if (conf.get('firewall') or {}).get(direction):
+                conf['firewall'][direction], n = compact_rules(conf['firewall'][direction])
+                removed += n
+        return dict(conf), removed
 
     @staticmethod
     def __load_stub(file: str) -> dict:
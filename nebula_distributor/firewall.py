@@ -0,0 +1,142 @@
+from typing import List, Tuple, Union
+
+any_port = (0, 65535)
+
+# Rule keys that decide who a rule lets in. A rule matches a packet if any of them match.
+identity_keys = {'host', 'group', 'groups', 'cidr'}
+
+
+def parse_port(value) -> Union[Tuple[int, int], None]:
+    """
+    A rule's port as a (start, end) range. None for ports that aren't a number or a range, like `fragment`.
+    """
+    s = str(value).strip()
+    if s in ('any', '0'):
+        return any_port
+    try:
+        if '-' in s:
+            start, end = s.split('-', 1)
+            return int(start), int(end)
+        return int(s), int(s)
+    except ValueError:
+        return None
+
+
+def format_port(start: int, end: int) -> Union[int, str]:
+    if (start, end) == any_port:
+        return 'any'
+    if start == end:
+        return start
+    return f'{start}-{end}'
+
+
+def canonicalize(rule: dict) -> dict:
+    """
+    Write a rule the same way every time: `any` instead of 0-65535, sorted groups and a single group as `group`.
+    Nothing else changes case, Nebula only takes the exact `any` as a wildcard and `host: ANY` is a hostname.
+    """
+    rule = dict(rule)
+    port = parse_port(rule.get('port'))
+    if port is not None:
+        rule['port'] = format_port(*port)
+    if isinstance(rule.get('groups'), list):
+        groups = sorted(set(str(x) for x in rule['groups']))
+        if len(groups) == 1 and 'group' not in rule:
+            del rule['groups']
+            rule['group'] = groups[0]
+        else:
+            rule['groups'] = groups
+    return rule
+
+
+def freeze(value):
+    if isinstance(value, list):
+        return tuple(freeze(x) for x in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    return value
+
+
+def identity(rule: dict) -> tuple:
+    """
+    Everything about a rule except its port and proto.
+    """
+    return tuple(sorted((k, freeze(v)) for k, v in rule.items() if k not in ('port', 'proto')))
+
+
+def matches_anyone(rule: dict) -> bool:
+    """
+    Whether the rule lets in every host. Like Nebula, that's `host: any`, `group: any` or a /0 cidr, even if the rule
+    also names a group, as long as nothing else (like ca_name) narrows it. Which local addresses it applies to is up
+    to `covers()`.
+    """
+    if not set(rule.keys()) - {'port', 'proto', 'local_cidr'} <= identity_keys:
+        return False
+    return rule.get('host') == 'any' or rule.get('group') == 'any' or 'any' in (rule.get('groups') or []) or str(rule.get('cidr')).endswith('/0')
+
+
+def covers(a: dict, b: dict) -> bool:
+    """
+    Whether rule `a` allows everything rule `b` does. Both have to have the same `local_cidr`: without one a rule only
+    applies to the host's own Nebula IP on Nebula versions where `default_local_cidr_any` is off, not to the unsafe
+    routes a rule with a `local_cidr` is for.
+    """
+    if a.get('local_cidr') != b.get('local_cidr'):
+        return False
+    if a.get('proto') != 'any' and a.get('proto') != b.get('proto'):
+        return False
+    a_port, b_port = parse_port(a.get('port')), parse_port(b.get('port'))
+    if a_port is None or b_port is None:
+        if a.get('port') != b.get('port'):
+            return False
+    elif not a_port[0] <= b_port[0] <= b_port[1] <= a_port[1]:
+        return False
+    return matches_anyone(a) or identity(a) == identity(b)
+
+
+def merge_ports(rules: List[dict]) -> List[dict]:
+    """
+    Merge rules that only differ in their port into one rule per run of overlapping or adjacent ports. The merged
+    rules take the place of the first rule of their kind.
+    """
+    kinds = {}
+    for rule in rules:
+        if parse_port(rule.get('port')) is not None:
+            kinds.setdefault((rule.get('proto'), identity(rule)), []).append(rule)
+
+    merged = []
+    done = set()
+    for rule in rules:
+        if parse_port(rule.get('port')) is None:
+            merged.append(rule)
+            continue
+        kind = (rule.get('proto'), identity(rule))
+        if kind in done:
+            continue
+        done.add(kind)
+        ranges = sorted(parse_port(x['port']) for x in kinds[kind])
+        runs = [list(ranges[0])]
+        for start, end in ranges[1:]:
+            if start <= runs[-1][1] + 1:
+                runs[-1][1] = max(runs[-1][1], end)
+            else:
+                runs.append([start, end])
+        for start, end in runs:
+            merged.append({**rule, 'port': format_port(start, end)})
+    return merged
+
+
+def compact_rules(rules: List[dict]) -> Tuple[List[dict], int]:
+    """
+    Canonicalize a list of firewall rules, drop duplicates, merge port ranges and drop rules that a broader rule
+    already allows. Nebula's rules only ever allow traffic so none of this changes what gets through.
+    Returns the rules and how many fewer there are.
+    """
+    unique = {}
+    for rule in rules:
+        rule = canonicalize(rule)
+        unique.setdefault(freeze(rule), rule)
+    compacted = merge_ports(list(unique.values()))
+    # When two rules allow the same thing (like `host: any` and `group: any`) keep the first one.
+    compacted = [b for i, b in enumerate(compacted) if not any(i != j and covers(a, b) and (j < i or not covers(b, a)) for j, a in enumerate(compacted))]
+    return compacted, len(rules) - len(compacted)
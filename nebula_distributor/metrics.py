@@ -0,0 +1,67 @@
+class Metrics:
+    """
+    Prometheus metrics for the distributor. Until `start()` is called (and when prometheus_client isn't installed)
+    every method does nothing, so the rest of the code can call them unconditionally.
+    """
+
+    def __init__(self):
+        self.enabled = False
+
+    def start(self, port: int, addr: str = '0.0.0.0') -> bool:
+        if self.enabled:
+            return True
+        try:
+            import prometheus_client as p  # only imported when metrics are asked for
+        except ImportError:  # metrics are optional
+            print('prometheus_client is not installed, not serving metrics.')
+            return False
+        self.deploys = p.Counter('nebula_distributor_deploys', 'Deploys to a host by outcome.', ['host', 'outcome'])
+        self.phases = p.Histogram('nebula_distributor_phase_seconds', 'How long each phase took for a host.', ['phase'],
+                                  buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+        self.ssh_retries = p.Counter('nebula_distributor_ssh_retries', 'SSH commands retried after a failure.', ['host'])
+        self.ssh_reconnects = p.Counter('nebula_distributor_ssh_reconnects', 'SSH connections reopened while retrying.', ['host'])
+        self.certs_signed = p.Counter('nebula_distributor_certs_signed', 'Certs signed by outcome.', ['outcome'])
+        self.uploaded = p.Counter('nebula_distributor_uploaded_bytes', 'Bytes uploaded to hosts over SFTP.')
+        self.skipped = p.Counter('nebula_distributor_skipped_unchanged', 'Hosts skipped because nothing changed since their last deploy.')
+        self.cert_expiry = p.Gauge('nebula_distributor_cert_expiry_timestamp_seconds', 'When each host cert expires.', ['host'])
+        p.start_http_server(port, addr=addr)
+        self.enabled = True
+        return True
+
+    def deploy(self, host: str, ok: bool):
+        if self.enabled:
+            self.deploys.labels(host, 'ok' if ok else 'failed').inc()
+
+    def phase(self, record: dict):
+        """
+        Observe a Tracer record.
+        """
+        if self.enabled:
+            self.phases.labels(record['phase']).observe(record['seconds'])
+
+    def ssh_retry(self, host: str):
+        if self.enabled:
+            self.ssh_retries.labels(host).inc()
+
+    def ssh_reconnect(self, host: str):
+        if self.enabled:
+            self.ssh_reconnects.labels(host).inc()
+
+    def cert_signed(self, ok: bool):
+        if self.enabled:
+            self.certs_signed.labels('ok' if ok else 'failed').inc()
+
+    def bytes_uploaded(self, n: int):
+        if self.enabled:
+            self.uploaded.inc(n)
+
+    def skipped_unchanged(self, n: int):
+        if self.enabled:
+            self.skipped.inc(n)
+
+    def cert_expires(self, host: str, timestamp: float):
+        if self.enabled:
+            self.cert_expiry.labels(host).set(timestamp)
+
+
+metrics = Metrics()
@@ -1,26 +1,83 @@
+import threading
 from getpass import getpass
-from typing import Union
+from typing import Dict, Iterable, Union
 
 import keyring
+from keyring.errors import KeyringError
 
 
 class Passwords:
-    auth = {}
     service_id = 'nebula-network-distributor'
 
     def __init__(self):
-        pass
+        self.auth = {}
 
     def set(self, username, password):
         self.auth[username] = password
         keyring.set_password(self.service_id, username, password)
 
-    def prompt(self, username):
+    def prompt(self, username) -> str:
         pw = getpass(f'[sudo] password for {username}: ')
         self.set(username, pw)
+        return pw
 
     def get(self, username) -> Union[str, None]:
         if username not in self.auth:
             return keyring.get_password(self.service_id, username)
         else:
             return self.auth[username]
+
+
+class CredentialBroker:
+    """
+    Sudo passwords for the deploy workers. `prefetch()` looks every username up in the keyring once (prompting if
+    asked to), after that `get()` is a dict lookup that never waits on the keyring. Passwords stay in memory for as
+    long as the process runs, daemon cycles included.
+    """
+
+    def __init__(self, passwords: Passwords = None):
+        self.passwords = passwords if passwords is not None else Passwords()
+        self.cache: Dict[str, Union[str, None]] = {}
+        self.asked = set()
+        self.lock = threading.Lock()
+
+    def lookup(self, username) -> Union[str, None]:
+        try:
+            return self.passwords.get(username)
+        except KeyringError as e:
+            print(f'Failed to read the sudo password for {username} from the keyring:', e)
+            return None
+
+    def prefetch(self, usernames: Iterable[str], ask: bool = False, overwrite: bool = False):
+        """
+        Look up the passwords of the usernames that haven't been looked up yet. With `ask`, prompt for the ones that
+        aren't saved (all of them with `overwrite`) and save them, each username is only asked for once.
+        """
+        with self.lock:
+            for username in sorted(set(usernames)):
+                if username in self.cache and (not ask or username in self.asked):
+                    continue
+                pw = self.cache[username] if username in self.cache else self.lookup(username)
+                if ask:
+                    self.asked.add(username)
+                    if pw is None or overwrite:
+                        print('sudo password not saved for username:', username)
+                        try:
+                            pw = self.passwords.prompt(username)
+                        except KeyringError as e:
+                            print('Failed to save the password to the keyring, keeping it in memory:', e)
+                            pw = self.passwords.auth[username]
+                    else:
+                        print('Retrieved sudo password for username:', username)
+                self.cache[username] = pw
+
+    def get(self, username) -> Union[str, None]:
+        try:
+            return self.cache[username]
+        except KeyError:
+            pass
+        # Not prefetched, look it up once.
+        with self.lock:
+            if username not in self.cache:
+                self.cache[username] = self.lookup(username)
+            return self.cache[username]
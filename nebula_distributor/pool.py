@@ -0,0 +1,82 @@
+import threading
+import time
+from typing import Dict, Tuple
+
+from .ssh import NebulaSSH
+
+
+class PooledConnection:
+    def __init__(self, conn: NebulaSSH):
+        self.conn = conn
+        self.last_used = time.time()
+        self.in_use = False
+
+
+class SSHPool:
+    """
+    Keeps authenticated connections open, keyed by (host, port, username), so that a host is only connected to once
+    per run and, in daemon mode, once across cycles. Connections that haven't been used for `max_idle` seconds are
+    closed.
+    """
+
+    def __init__(self, timeout: int = 3, keepalive: int = 30, max_idle: int = 300):
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.max_idle = max_idle
+        self.connections: Dict[Tuple[str, int, str], PooledConnection] = {}
+        self.lock = threading.Lock()
+
+    def get(self, host: str, username: str, port: int = 22, sudo_password: str = None) -> NebulaSSH:
+        """
+        Get the pooled connection to a host. It isn't connected yet if `is_alive()` returns False.
+        """
+        self.evict_idle()
+        key = (host, port, username)
+        with self.lock:
+            pooled = self.connections.get(key)
+            if pooled is not None and (not pooled.conn.is_alive() or pooled.conn.sudo_password != sudo_password):
+                self.close_conn(pooled.conn)
+                pooled = None
+            if pooled is None:
+                pooled = PooledConnection(NebulaSSH(host=host, username=username, port=port, timeout=self.timeout, sudo_password=sudo_password, keepalive=self.keepalive))
+                self.connections[key] = pooled
+            pooled.in_use = True
+            pooled.last_used = time.time()
+            return pooled.conn
+
+    def release(self, conn: NebulaSSH):
+        with self.lock:
+            pooled = self.connections.get((conn.host, conn.port, conn.username))
+            if pooled is not None and pooled.conn is conn:
+                pooled.in_use = False
+                pooled.last_used = time.time()
+
+    def discard(self, conn: NebulaSSH):
+        """
+        Close a connection that can't be used any more, like one to a host's old IP, and drop it from the pool.
+        """
+        with self.lock:
+            key = (conn.host, conn.port, conn.username)
+            pooled = self.connections.get(key)
+            if pooled is not None and pooled.conn is conn:
+                del self.connections[key]
+        self.close_conn(conn)
+
+    def evict_idle(self):
+        now = time.time()
+        with self.lock:
+            for key, pooled in list(self.connections.items()):
+                if not pooled.in_use and now - pooled.last_used > self.max_idle:
+                    self.close_conn(pooled.conn)
+                    del self.connections[key]
+
+    def close_all(self):
+        with self.lock:
+            for pooled in self.connections.values():
+                self.close_conn(pooled.conn)
+            self.connections = {}
+
+    @staticmethod
+    def close_conn(conn: NebulaSSH):
+        if conn.conn is not None:
+            conn.close()
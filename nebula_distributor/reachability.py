@@ -0,0 +1,47 @@
+import asyncio
+import time
+from typing import Dict, Iterable, NamedTuple, Tuple, Union
+
+
+class ProbeResult(NamedTuple):
+    host: str
+    port: int
+    up: bool
+    latency: Union[float, None]  # seconds to open the TCP connection
+    error: Union[str, None]
+    seconds: float = 0  # how long the probe took, whether it worked or not
+
+
+async def probe(host: str, port: int, timeout: float) -> ProbeResult:
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except asyncio.TimeoutError:
+        return ProbeResult(host, port, False, None, f'timed out after {timeout}s', time.perf_counter() - start)
+    except OSError as e:
+        return ProbeResult(host, port, False, None, e.strerror or str(e), time.perf_counter() - start)
+    latency = time.perf_counter() - start
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return ProbeResult(host, port, True, latency, None, latency)
+
+
+async def sweep_async(targets: Iterable[Tuple[str, int]], timeout: float, concurrency: int) -> list:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(host, port):
+        async with semaphore:
+            return await probe(host, port, timeout)
+
+    return await asyncio.gather(*(limited(host, port) for host, port in targets))
+
+
+def sweep(targets: Iterable[Tuple[str, int]], timeout: float = 3, concurrency: int = 256) -> Dict[Tuple[str, int], ProbeResult]:
+    """
+    Check that TCP connections to all the (host, port) targets can be opened, all at once.
+    """
+    targets = list(dict.fromkeys(targets))
+    return {(x.host, x.port): x for x in asyncio.run(sweep_async(targets, timeout, concurrency))}
@@ -0,0 +1,46 @@
+import socket
+import time
+from typing import Callable
+
+# netifaces is imported where it's used, most runs never look at the local interfaces.
+
+
+def backoff_delay(attempt: int, initial: float = 0.25, factor: float = 2, max_delay: float = 5) -> float:
+    return min(initial * factor ** attempt, max_delay)
+
+
+def wait_for(check: Callable[[], bool], timeout: float = 30, initial: float = 0.1, factor: float = 2, max_delay: float = 2) -> bool:
+    """
+    Call `check` with exponential backoff between attempts until it returns True or `timeout` seconds have passed.
+    """
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        if check():
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(backoff_delay(attempt, initial, factor, max_delay), remaining))
+        attempt += 1
+
+
+def get_ip_addresses() -> list:
+    import netifaces
+    addresses = []
+    for ifname in [y for x, y in socket.if_nameindex()]:
+        try:
+            ip = netifaces.ifaddresses(ifname)[netifaces.AF_INET][0]['addr']
+        except KeyError:
+            ip = None
+        addresses.append(ip)
+    return addresses
+
+
+def interface_has_ip(ip: str) -> bool:
+    import netifaces
+    for ifname in netifaces.interfaces():
+        for addr in netifaces.ifaddresses(ifname).get(netifaces.AF_INET, []):
+            if addr.get('addr') == ip:
+                return True
+    return False
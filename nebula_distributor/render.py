@@ -0,0 +1,72 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Tuple
+
+import yaml
+
+from .config_builder import HostBuilder
+
+
+# libyaml's emitter is a lot faster than the pure-Python one but isn't always compiled in.
+class ConfigDumper(getattr(yaml, 'CSafeDumper', yaml.SafeDumper)):
+    def ignore_aliases(self, data):
+        return True  # hosts share parts of their configs, don't print pointers for them
+
+
+# Below this many hosts starting the worker processes takes longer than rendering.
+parallel_threshold = 64
+
+worker_builder = None
+
+
+def dump_config(conf: dict) -> str:
+    return yaml.dump(conf, Dumper=ConfigDumper, default_flow_style=False)
+
+
+def config_header(hostname: str, host: dict, type: str, created: str) -> str:
+    return '\n'.join([
+        f'# Nebula hostname: {hostname}',
+        f'# nebula_ip: {host["nebula_ip"]}',
+        f'# Type: {type}',
+        f'# groups: {", ".join(host["groups"])}',
+        f'# Config built: {created}',
+        '',
+        '',
+    ])
+
+
+def render_host(builder: HostBuilder, hostname: str, host: dict, type: str) -> Tuple[str, int]:
+    """
+    The host's config as yaml and how many firewall rules were compacted away.
+    """
+    host_base_config = builder.lighthouse_base if type == 'lighthouse' else builder.host_base
+    conf = builder.build_config(hostname, builder.base, host_base_config, host)
+    return dump_config(conf), builder.removed_rules(builder.base, host_base_config, host)
+
+
+def init_worker(builder: HostBuilder):
+    global worker_builder
+    worker_builder = builder
+
+
+def render_worker(item: Tuple[str, dict, str]) -> Tuple[str, int]:
+    return render_host(worker_builder, *item)
+
+
+def render_configs(builder: HostBuilder, hosts: List[Tuple[str, dict, str]], workers: int = None) -> Iterator[Tuple[str, dict, str, str, int]]:
+    """
+    Render the configs for (hostname, host, type) items, spread over a pool of processes when there are enough hosts.
+    Yields (hostname, host, type, yaml, removed firewall rules) in the same order as `hosts` as soon as each one is
+    ready.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers < 2 or len(hosts) < parallel_threshold:
+        for hostname, host, type in hosts:
+            yield (hostname, host, type, *render_host(builder, hostname, host, type))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(builder,)) as pool:
+        results = pool.map(render_worker, hosts, chunksize=max(1, len(hosts) // (workers * 4)))
+        for (hostname, host, type), (body, removed) in zip(hosts, results):
+            yield hostname, host, type, body, removed
@@ -0,0 +1,138 @@
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Tuple, Union
+
+
+class HostOutput:
+    """
+    Stand-in for sys.stdout that buffers everything a worker thread prints so that each host's output is written
+    as one block instead of being interleaved with the other workers.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def write(self, s):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            with self.lock:
+                return self.stream.write(s)
+        buffer.append(s)
+        return len(s)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+    def begin(self):
+        self.local.buffer = []
+
+    def end(self):
+        buffer = self.local.buffer
+        self.local.buffer = None
+        with self.lock:
+            self.stream.write(''.join(buffer))
+            self.stream.flush()
+
+    def __getattr__(self, item):
+        return getattr(self.stream, item)
+
+
+def plan_waves(machines: List[dict], canary: Union[int, list] = 0, wave_size: int = 0) -> List[Tuple[str, List[dict]]]:
+    """
+    Order machines into rollout waves: lighthouses (and the relays defined with them) first, then the canary hosts,
+    then everything else in batches of `wave_size` (0 means one batch). `canary` is either a number of hosts to take
+    from the front of the list or a list of hostnames.
+    """
+    lighthouses = [m for m in machines if m['type'] == 'lighthouse']
+    rest = [m for m in machines if m['type'] != 'lighthouse']
+    if isinstance(canary, int):
+        canaries = rest[:canary]
+    else:
+        canaries = [m for m in rest if m['hostname'] in canary]
+    rest = [m for m in rest if m not in canaries]
+
+    waves = []
+    if len(lighthouses):
+        waves.append(('lighthouses', lighthouses))
+    if len(canaries):
+        waves.append(('canary', canaries))
+    size = wave_size if wave_size > 0 else max(len(rest), 1)
+    for n, i in enumerate(range(0, len(rest), size)):
+        waves.append((f'wave {n + 1}', rest[i:i + size]))
+    return waves
+
+
+class Rollout:
+    """
+    Run the per-host pipeline over a list of machines, optionally with a bounded pool of worker threads.
+    `worker` is called with a machine dict and returns a list of (hostname, ip, reason) failures.
+    """
+
+    def __init__(self, worker: Callable[[dict], list], parallel: int = 1):
+        self.worker = worker
+        self.parallel = max(1, parallel)
+        self.failed = []
+        self.lock = threading.Lock()
+        self.wave_times = []  # (name, host count, seconds, failed host count)
+        self.aborted = False
+
+    def run_waves(self, waves: List[Tuple[str, List[dict]]], max_failure_ratio: float = 1.0) -> List[tuple]:
+        """
+        Run each wave to completion before starting the next. Once the share of failed hosts out of every host
+        attempted so far goes over `max_failure_ratio` the remaining waves are skipped.
+        """
+        attempted = 0
+        failed_hosts = set()
+        for i, (name, machines) in enumerate(waves):
+            print(f'\n### Starting {name} ({len(machines)} hosts)')
+            start = time.time()
+            wave_failed = {x[0] for x in self.run(machines)} - failed_hosts
+            self.wave_times.append((name, len(machines), time.time() - start, len(wave_failed)))
+            failed_hosts |= wave_failed
+            attempted += len(machines)
+            if len(failed_hosts) / attempted > max_failure_ratio and i < len(waves) - 1:
+                print(f'\n### Aborting rollout: {len(failed_hosts)}/{attempted} hosts failed (max ratio {max_failure_ratio}).')
+                self.aborted = True
+                for _, skipped in waves[i + 1:]:
+                    self.failed.extend((m['hostname'], m['host'], 'Skipped, rollout aborted.') for m in skipped)
+                break
+        return self.failed
+
+    def run(self, machines: Iterable[dict]) -> List[tuple]:
+        if self.parallel == 1:
+            for machine in machines:
+                self.run_one(machine)
+            return self.failed
+
+        output = HostOutput(sys.stdout)
+        sys.stdout = output
+        try:
+            with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+                list(pool.map(lambda m: self.run_grouped(output, m), machines))
+        finally:
+            sys.stdout = output.stream
+        return self.failed
+
+    def run_grouped(self, output: HostOutput, machine: dict) -> list:
+        output.begin()
+        try:
+            return self.run_one(machine)
+        finally:
+            output.end()
+
+    def run_one(self, machine: dict) -> list:
+        try:
+            failed = self.worker(machine) or []
+        except Exception as e:
+            print('EXCEPTION:', e)
+            print(traceback.format_exc())
+            failed = [(machine['hostname'], machine['host'], e)]
+        with self.lock:
+            self.failed.extend(failed)
+        return failed
@@ -1,29 +1,33 @@
+import gzip
 import os
 import shutil
-import subprocess
-import tempfile
+import tarfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Union
+from typing import Iterator, List, Tuple, Union
 
 
-def create_installer_archive(hostname: str, output: Union[str, Path], config_path: Union[str, Path], host_key_path: Union[str, Path], host_crt_path: Union[str, Path], ca_crt_path: Union[str, Path], nebula_files: str, init_type: str, keep_nebula_crt: bool = False):
-    tmp_script = str(tempfile.mkstemp()[1])
-    tmp_dir = Path(tempfile.mkdtemp())
-    tmp_archive_dir = Path(tempfile.mkdtemp())
+def tar_member(name: str, data: bytes, mode: int = 0o644, mtime: float = 0) -> bytes:
+    """
+    One file as a tar header, its data and the padding to the next 512 byte block.
+    """
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = mode
+    info.mtime = int(mtime)
+    return info.tobuf(format=tarfile.GNU_FORMAT) + data + b'\0' * (-len(data) % tarfile.BLOCKSIZE)
 
-    os.mkdir(tmp_dir / 'etc')
 
-    if nebula_files:
-        shutil.copytree(nebula_files, tmp_dir / 'nebula')
-        if not keep_nebula_crt:
-            os.remove(tmp_dir / 'nebula' / 'nebula-cert')
+def installer_script(init_type: str, with_binaries: bool = True) -> str:
+    """
+    The shell script at the front of an installer. It extracts the archive appended after the `#EOF#` line.
+    """
+    if with_binaries:
         mv_nebula_str = 'mv $TMP/nebula/* /usr/sbin'
     else:
         mv_nebula_str = ''
-    shutil.copy(config_path, tmp_dir / 'etc' / 'config.yaml')
-    shutil.copy(host_key_path, tmp_dir / 'etc' / 'host.key')
-    shutil.copy(host_crt_path, tmp_dir / 'etc' / 'host.crt')
-    shutil.copy(ca_crt_path, tmp_dir / 'etc' / 'ca.crt')
 
     # /usr/local/bin/
 
@@ -46,7 +50,8 @@ sed '0,/^#EOF#$/d' $0 | tar xzv -C "$TMP"
 echo "Copying files..."
 mkdir -p /etc/nebula/
 {mv_nebula_str}
-mv $TMP/etc/* /etc/nebula/"""
+mv $TMP/etc/* /etc/nebula/
+"""
 
     if init_type == 'systemd':
         sfx_file = sfx_file + """echo "Setting up service..."
@@ -101,12 +106,62 @@ echo "All done!"
 exit 0
 #EOF#
 """
-    f = open(tmp_script, 'w')
-    f.write(sfx_file)
-    f.close()
-
-    subprocess.run(f'cd "{tmp_dir}" && tar -czvf "{tmp_archive_dir / "data.tar.gz"}" .', shell=True)
-    subprocess.run(f'cat "{tmp_script}" "{tmp_archive_dir / "data.tar.gz"}" > "{os.path.join(output, hostname + "-installer.run")}"', shell=True)
-
-    os.remove(tmp_script)
-    shutil.rmtree(tmp_archive_dir)  # shutil.rmtree(tmp_dir)
+    return sfx_file
+
+
+def create_installer_archive(hostname: str, output: Union[str, Path], config: str, host_key: str, host_crt: str, ca_crt: str, payload: Union[str, Path, None], init_type: str) -> int:
+    """
+    Write `<hostname>-installer.run`: the install script, then `payload` (the binaries, see ReleaseCache.payload) and
+    then a gzip member with the host's config and certs. tar reads the concatenated gzip members as one archive.
+    Everything is streamed into the output file, which is renamed into place when it's done. Returns its size.
+    """
+    path = Path(output, f'{hostname}-installer.run')
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    now = time.time()
+    try:
+        with open(tmp, 'wb') as out:
+            out.write(installer_script(init_type, with_binaries=bool(payload)).encode())
+            if payload:
+                with open(payload, 'rb') as file:
+                    shutil.copyfileobj(file, out, 1 << 20)
+            with gzip.GzipFile(fileobj=out, mode='wb', mtime=int(now)) as gz:
+                gz.write(tar_member('etc/config.yaml', config.encode(), mtime=now))
+                gz.write(tar_member('etc/host.key', host_key.encode(), mode=0o600, mtime=now))
+                gz.write(tar_member('etc/host.crt', host_crt.encode(), mtime=now))
+                gz.write(tar_member('etc/ca.crt', ca_crt.encode(), mtime=now))
+                gz.write(b'\0' * tarfile.BLOCKSIZE * 2)  # end of archive
+            size = out.tell()
+        os.chmod(tmp, 0o755)
+        tmp.replace(path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return size
+
+
+def build_installer(job: dict) -> Tuple[dict, int, float, Union[str, None]]:
+    """
+    Run create_installer_archive with the arguments in `job` (plus its `arch`, which is only passed through).
+    Returns the job, the size of the installer, how long it took and the error if it failed.
+    """
+    start = time.time()
+    try:
+        size = create_installer_archive(**{k: v for k, v in job.items() if k != 'arch'})
+    except Exception as e:
+        return job, 0, time.time() - start, f'{type(e).__name__}: {e}'
+    return job, size, time.time() - start, None
+
+
+def build_installers(jobs: List[dict], workers: int = None) -> Iterator[Tuple[dict, int, float, Union[str, None]]]:
+    """
+    Build installers for a list of build_installer jobs, spread over a pool of processes. Yields the results of
+    build_installer in the same order as `jobs`.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers < 2 or len(jobs) < 2:
+        yield from map(build_installer, jobs)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+        yield from pool.map(build_installer, jobs, chunksize=max(1, len(jobs) // (workers * 4)))
@@ -3,32 +3,24 @@ import socket
 import subprocess
 import time
 from getpass import getpass
-from pathlib import Path
-from typing import Union
+from pathlib import Path, PurePosixPath
+from typing import Callable, Dict, Union
+from uuid import uuid4
 
 import invoke
-import netifaces
 import paramiko
 from fabric import Connection, Config
 from fabric import Result
 
-logger = logging.getLogger('distributor')
-
+from .commands import build_move_into_place
+from .metrics import metrics
+from .readiness import backoff_delay, get_ip_addresses  # noqa: F401, get_ip_addresses used to live here
 
-def get_ip_addresses() -> list:
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    addresses = []
-    for ifname in [y for x, y in socket.if_nameindex()]:
-        try:
-            ip = netifaces.ifaddresses(ifname)[netifaces.AF_INET][0]['addr']
-        except KeyError:
-            ip = None
-        addresses.append(ip)
-    return addresses
+logger = logging.getLogger('distributor')
 
 
 class NebulaSSH:
-    def __init__(self, host: str, username: str, port: int = 22, known_hosts_file: Union[str, Path] = None, timeout: int = 3, sudo_password: str = None, retries: int = 20):
+    def __init__(self, host: str, username: str, port: int = 22, known_hosts_file: Union[str, Path] = None, timeout: int = 3, sudo_password: str = None, retries: int = 20, keepalive: int = 0):
         self.host = host
         self.port = port
         self.username = username
@@ -38,6 +30,7 @@ class NebulaSSH:
         self.sudo_password = None
         self.config = Config()
         self.retries = retries  # How many times we retry a command. Sometimes a sudo command failes for no reason.
+        self.keepalive = keepalive  # Seconds between keepalive packets, 0 to disable.
 
         if sudo_password:
             self.set_sudo_password(sudo_password)
@@ -57,13 +50,15 @@ class NebulaSSH:
     def connect(self, fail_soft: bool = False, print_err: bool = False) -> Union[Connection, None]:
         def do():
             for i in range(self.timeout):
-                self.conn = Connection(host=self.host, user=self.username, port=self.port, config=self.config)
+                self.conn = Connection(host=self.host, user=self.username, port=self.port, config=self.config, connect_timeout=self.timeout)
                 try:
                     self.conn.open()
                 except paramiko.ssh_exception.AuthenticationException:
                     self.copy_keys()
                     continue
                 if self.conn.is_connected:
+                    if self.keepalive:
+                        self.conn.transport.set_keepalive(self.keepalive)
                     return self.conn
                 elif print_err:
                     print('Failed to connect, retrying...')
@@ -96,25 +91,30 @@ class NebulaSSH:
         subprocess.run(cmd, shell=True)
         # os.system(cmd)
 
-    def execute(self, cmd: str, sudo=False, print_err: bool = False) -> Union[Result, None]:
+    def execute(self, cmd: str, sudo=False, print_err: bool = False, retries: int = None) -> Union[Result, None]:
+        if retries is None:
+            retries = self.retries
         if sudo:
             exe = self.conn.sudo
         else:
             exe = self.conn.run
         failed = False
-        for i in range(self.retries):
+        for i in range(retries):
             try:
-                if failed and print_err:
-                    print('\n\nEncountered error.')
-                    print(f'Retry {i}/{self.retries}...\nSleeping 2s...')
-                    time.sleep(2)
+                if failed:
+                    delay = backoff_delay(i - 1)
+                    if print_err:
+                        print('\n\nEncountered error.')
+                        print(f'Retry {i}/{retries}...\nSleeping {delay:.2f}s...')
+                    time.sleep(delay)
+                    metrics.ssh_retry(self.host)
                     if not i % 5:
-                        print('Reconnecting every 5 failures...')
+                        print('Reconnecting every 5 failures...') if print_err else None
+                        metrics.ssh_reconnect(self.host)
                         self.close()
-                        del self.conn
                         self.connect()
-                        print('Connected!\nSleeping 10s...')
-                        time.sleep(10)
+                        exe = self.conn.sudo if sudo else self.conn.run
+                        print('Connected!') if print_err else None
                 failed = False
                 x = exe(cmd, hide=True)
                 x.stdout = x.stdout.strip()
@@ -123,7 +123,6 @@ class NebulaSSH:
                 if print_err:
                     print(e)
                 failed = True
-                time.sleep(2)
             except paramiko.ssh_exception.AuthenticationException as e:
                 print('Authentication failure:', e)
                 self.copy_keys()
@@ -142,11 +141,12 @@ class NebulaSSH:
     def close(self):
         self.conn.close()
 
+    def is_alive(self) -> bool:
+        return self.conn is not None and self.conn.is_connected
+
     def check_host_up(self):
         try:
-            socket.setdefaulttimeout(self.timeout)
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((self.host, self.port))
+            s = socket.create_connection((self.host, self.port), timeout=self.timeout)
         except OSError as e:
             return False
         else:
@@ -161,3 +161,70 @@ class NebulaSSH:
     #     return outputs
     def sudo(self, cmd, print_err: bool = False) -> Result:
         return self.execute(cmd, sudo=True, print_err=print_err)
+
+    def upload_files(self, files: Dict[str, Union[str, bytes]], use_sudo: bool = True, print_err: bool = False, install_cmd: Callable[[str, Dict[str, str]], str] = None, attempts: int = 5) -> Union[Result, None]:
+        """
+        Upload files (remote path -> content) to a private temp dir over one SFTP session, then move all of them into
+        place with a single command. `install_cmd` builds that command from the temp dir and the staged files
+        (staged path -> remote path) and must remove the temp dir when it's done. If the connection fails during the
+        upload or the install the files are staged again and installed again, up to `attempts` times in all. An install
+        command that exits non-zero isn't retried, its result is returned as is.
+        """
+        if install_cmd is None:
+            install_cmd = lambda tmp, staged: build_move_into_place(tmp, staged, use_sudo=False)
+        x = None
+        for i in range(attempts):
+            if i:
+                delay = backoff_delay(i - 1)
+                print(f'Retrying upload {i}/{attempts - 1}, sleeping {delay:.2f}s...') if print_err else None
+                time.sleep(delay)
+                metrics.ssh_retry(self.host)
+                # Always on a new connection: fabric keeps using the SFTP session of a dropped one even after it reconnects.
+                print('Reconnecting...') if print_err else None
+                metrics.ssh_reconnect(self.host)
+                self.close()
+                if self.connect() is None:
+                    break
+            x = self.stage_and_install(files, use_sudo, print_err, install_cmd)
+            if x is not None:
+                break
+        return x
+
+    def stage_and_install(self, files: Dict[str, Union[str, bytes]], use_sudo: bool, print_err: bool, install_cmd: Callable[[str, Dict[str, str]], str]) -> Union[Result, None]:
+        tmp_dir = f'/tmp/nebula-distributor-{uuid4().hex}'
+        staged = {}
+        try:
+            sftp = self.conn.sftp()
+            sftp.mkdir(tmp_dir, mode=0o700)
+            for remote_path, content in files.items():
+                staged_path = f'{tmp_dir}/{PurePosixPath(remote_path).name}'
+                data = content.encode() if isinstance(content, str) else content
+                with sftp.open(staged_path, 'wb') as f:
+                    f.set_pipelined(True)
+                    f.write(data)
+                metrics.bytes_uploaded(len(data))
+                staged[staged_path] = remote_path
+        except (IOError, EOFError, paramiko.ssh_exception.SSHException) as e:
+            if print_err:
+                print('Upload failed:', e)
+            try:
+                self.execute(f'rm -rf {tmp_dir}', retries=1)
+            except (IOError, EOFError, paramiko.ssh_exception.SSHException):
+                pass  # the connection is gone
+            return None
+        # Not through execute(), the staged files are gone after the first attempt and a command that failed (like a
+        # config that doesn't pass `nebula -test`) would only fail again.
+        try:
+            exe = self.conn.sudo if use_sudo else self.conn.run
+            x = exe(install_cmd(tmp_dir, staged), hide=True, warn=True)
+            if x.return_code == -1:  # no exit status, the connection dropped while it ran
+                print('Install failed: the connection dropped.') if print_err else None
+                return None
+            x.stdout = x.stdout.strip()
+            if x.return_code and print_err:
+                print(f'Install exited with {x.return_code}:', x.stderr.strip())
+            return x
+        except (IOError, EOFError, paramiko.ssh_exception.SSHException) as e:
+            if print_err:
+                print('Install failed:', e)
+            return None
@@ -0,0 +1,64 @@
+import hashlib
+import json
+import threading
+from pathlib import Path
+from typing import Union
+
+
+def content_digest(*parts: Union[str, bytes, None]) -> str:
+    """
+    SHA-256 over all the parts. Each part is length-prefixed so moving bytes from one part to another changes the digest.
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        if part is None:
+            part = b''
+        elif isinstance(part, str):
+            part = part.encode()
+        h.update(len(part).to_bytes(8, 'big'))
+        h.update(part)
+    return h.hexdigest()
+
+
+class DeployState:
+    """
+    The digests of the config and the certs last successfully deployed to each host, kept in a local JSON file between
+    runs. They're kept apart because a run without --generate-certs only installs the config.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.digests = {}
+        if self.path.exists():
+            with open(self.path, 'r') as file:
+                self.digests = json.load(file)
+
+    def get(self, hostname: str) -> dict:
+        x = self.digests.get(hostname)
+        return x if isinstance(x, dict) else {}  # older state files have one digest per host, that's as good as nothing
+
+    def unchanged(self, hostname: str, config_digest: str, certs_digest: str = None) -> bool:
+        """
+        Whether the host already has this config and, unless `certs_digest` is None, these certs.
+        """
+        x = self.get(hostname)
+        return x.get('config') == config_digest and (certs_digest is None or x.get('certs') == certs_digest)
+
+    def set(self, hostname: str, config_digest: str, certs_digest: str = None):
+        """
+        Record a deploy. When no certs were installed (`certs_digest` is None) the host keeps the certs it had.
+        """
+        with self.lock:
+            x = dict(self.get(hostname))
+            x['config'] = config_digest
+            if certs_digest is not None:
+                x['certs'] = certs_digest
+            self.digests[hostname] = x
+
+    def save(self):
+        with self.lock:
+            tmp = self.path.with_suffix('.tmp')
+            with open(tmp, 'w') as file:
+                json.dump(self.digests, file, indent=2, sort_keys=True)
+            tmp.replace(self.path)
@@ -0,0 +1,89 @@
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Union
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    Nearest-rank percentile of a non-empty list.
+    """
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class Tracer:
+    """
+    Records how long each phase took for each host and whether it worked. Phases that run for all hosts at once
+    are recorded with host `*`. `on_record` is called with each record as it's added.
+    """
+
+    def __init__(self, on_record: Callable[[dict], None] = None):
+        self.records = []
+        self.lock = threading.Lock()
+        self.on_record = on_record
+
+    def add(self, record: dict):
+        with self.lock:
+            self.records.append(record)
+        if self.on_record:
+            self.on_record(record)
+
+    @contextmanager
+    def phase(self, host: str, name: str):
+        """
+        Time the block as phase `name` of `host`. It counts as failed if it raises, or if the block sets `ok` to
+        False on the record it gets.
+        """
+        record = {'host': host, 'phase': name, 'start': time.time(), 'seconds': None, 'ok': True, 'error': None}
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record['ok'] = False
+            record['error'] = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            self.add(record)
+
+    def record(self, host: str, name: str, seconds: float, ok: bool = True, error: str = None):
+        """
+        Add a phase that was timed somewhere else, like in another process.
+        """
+        self.add({'host': host, 'phase': name, 'start': time.time() - seconds, 'seconds': seconds, 'ok': ok, 'error': error})
+
+    def summary(self) -> Dict[str, dict]:
+        """
+        phase -> count, failed, total, p50, p95 and max seconds, in the order the phases first ran.
+        """
+        phases = {}
+        for x in self.records:
+            phases.setdefault(x['phase'], []).append(x)
+        summary = {}
+        for name, records in phases.items():
+            seconds = [x['seconds'] for x in records]
+            summary[name] = {
+                'count': len(records),
+                'failed': len([x for x in records if not x['ok']]),
+                'total': sum(seconds),
+                'p50': percentile(seconds, 50),
+                'p95': percentile(seconds, 95),
+                'max': max(seconds),
+            }
+        return summary
+
+    def slowest(self, n: int = 5) -> List[dict]:
+        return sorted((x for x in self.records if x['host'] != '*'), key=lambda x: x['seconds'], reverse=True)[:n]
+
+    def write_report(self, path: Union[str, Path]):
+        """
+        Append one JSON line per record and a final line with the summary.
+        """
+        with open(path, 'a') as file:
+            for x in self.records:
+                file.write(json.dumps(x) + '\n')
+            file.write(json.dumps({'summary': self.summary(), 'end': time.time()}) + '\n')
@@ -0,0 +1,34 @@
+import hashlib
+from typing import Dict, List, NamedTuple, Union
+
+
+class VerifyResult(NamedTuple):
+    path: str
+    expected: str
+    actual: Union[str, None]  # None when the file is missing on the host
+
+    @property
+    def ok(self) -> bool:
+        return self.expected == self.actual
+
+
+def sha256_digest(content: Union[str, bytes]) -> str:
+    if isinstance(content, str):
+        content = content.encode()
+    return hashlib.sha256(content).hexdigest()
+
+
+def parse_sha256sum(output: str) -> Dict[str, str]:
+    """
+    Parse the output of `sha256sum` into a dict of path -> digest.
+    """
+    digests = {}
+    for line in output.strip().splitlines():
+        parts = line.strip().split(maxsplit=1)
+        if len(parts) == 2:
+            digests[parts[1].lstrip('*')] = parts[0].lower()
+    return digests
+
+
+def compare_digests(expected: Dict[str, str], actual: Dict[str, str]) -> List[VerifyResult]:
+    return [VerifyResult(path, digest, actual.get(path)) for path, digest in expected.items()]
@@ -0,0 +1,86 @@
+import os
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Set, Tuple, Union
+
+try:
+    import inotify_simple
+except ImportError:  # fall back to polling
+    inotify_simple = None
+
+
+class Watcher:
+    """
+    Watch files and directories for changes, directories recursively. Uses inotify when `inotify_simple` is installed, otherwise
+    polls the modification times every `interval` seconds. Either way, what changed is worked out by comparing
+    snapshots so both report the same thing.
+    """
+
+    def __init__(self, paths: Iterable[Union[str, Path]], debounce: float = 2, interval: float = 2):
+        self.paths = [Path(x) for x in paths]
+        self.debounce = debounce
+        self.interval = interval
+        self.inotify = None
+        if inotify_simple is not None:
+            self.inotify = inotify_simple.INotify()
+            self.add_watches()
+        self.snapshot = self.scan()
+
+    def add_watches(self):
+        flags = inotify_simple.flags
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.CREATE | flags.DELETE
+        for path in self.paths:
+            if path.is_dir():
+                for directory, _, _ in os.walk(path):
+                    self.inotify.add_watch(directory, mask)
+            elif path.parent.is_dir():
+                # Only the directory of a single file, not its subdirectories. Editors often replace files instead of
+                # writing to them, so watching the file itself would lose track of it.
+                self.inotify.add_watch(path.parent, mask)
+
+    def scan(self) -> Dict[Path, Tuple[int, int]]:
+        snapshot = {}
+        for path in self.paths:
+            files = [path] if path.is_file() else [Path(d, f) for d, _, names in os.walk(path) for f in names]
+            for file in files:
+                try:
+                    stat = file.stat()
+                except FileNotFoundError:
+                    continue
+                snapshot[file] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def changes(self) -> Set[Path]:
+        snapshot = self.scan()
+        changed = {x for x in snapshot.keys() | self.snapshot.keys() if snapshot.get(x) != self.snapshot.get(x)}
+        self.snapshot = snapshot
+        return changed
+
+    def wait(self, timeout: float = None) -> Set[Path]:
+        """
+        Block until something changes and then until there haven't been any more changes for `debounce` seconds.
+        Returns the changed files, or an empty set if nothing changed within `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        changed = set()
+        while not changed:
+            if deadline is not None and time.monotonic() >= deadline:
+                return changed
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if self.inotify is not None:
+                self.inotify.read(timeout=None if remaining is None else int(remaining * 1000))
+            else:
+                time.sleep(self.interval if remaining is None else min(self.interval, remaining))
+            changed = self.changes()
+
+        while True:
+            if self.inotify is not None:
+                self.add_watches()  # pick up new directories
+                quiet = not self.inotify.read(timeout=int(self.debounce * 1000))
+            else:
+                time.sleep(self.debounce)
+                quiet = True
+            more = self.changes()
+            if quiet and not more:
+                return changed
+            changed |= more
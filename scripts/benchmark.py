@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Benchmark config building, cert signing and SFX packaging against synthetic fleets.
+
+    ./scripts/benchmark.py --hosts 100 1000 10000 --output bench.json
+
+Everything runs in a temp dir with a generated inventory and a stub nebula-cert, so nothing outside of it is touched.
+Results are JSON so runs from different commits can be compared.
+"""
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+import yaml
+
+repo = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(repo))
+
+from nebula_distributor import HostBuilder, NebulaCerts, NebulaPaths  # noqa: E402
+from nebula_distributor.render import dump_config, render_configs  # noqa: E402
+from nebula_distributor.sfx import build_installers, tar_member  # noqa: E402
+
+# Stand-in for nebula-cert: `sign` writes what `print -json` would output into the cert, `print` reads it back.
+# The CA cert is in the same format, see stub_ca_crt.
+# It's a shell script so the time measured is the distributor's and not the interpreter starting up.
+stub_nebula_cert = r"""#!/bin/sh
+cmd=$1
+shift
+while [ $# -gt 0 ]; do
+  case $1 in
+    -json) shift; continue ;;
+    -name) name=$2 ;;
+    -ip) ip=$2 ;;
+    -groups) groups=$2 ;;
+    -out-crt) crt=$2 ;;
+    -out-key) key=$2 ;;
+    -ca-crt) ca=$2 ;;
+    -path) path=$2 ;;
+  esac
+  shift 2
+done
+if [ "$cmd" = sign ]; then
+  if [ -n "$groups" ]; then groups="\"$(echo "$groups" | sed 's/,/","/g')\""; fi
+  issuer=$(sed -n 's/.*"fingerprint": "\([^"]*\)".*/\1/p' "$ca")
+  echo "{\"fingerprint\": \"stub-$name\", \"details\": {\"name\": \"$name\", \"ips\": [\"$ip\"], \"groups\": [$groups], \"notAfter\": \"2099-01-01T00:00:00Z\", \"issuer\": \"$issuer\"}}" > "$crt"
+  echo "KEY $name" > "$key"
+elif [ "$cmd" = print ]; then
+  cat "$path"
+fi
+"""
+stub_ca_crt = '{"fingerprint": "stub-ca", "details": {"name": "CA", "ips": [], "groups": [], "notAfter": "2099-01-01T00:00:00Z", "issuer": ""}}\n'
+
+
+def write_yaml(path: Path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as file:
+        yaml.safe_dump(data, file)
+
+
+def generate_inventory(root: Path, hosts: int, groups: int, extras: int, overrides: int, firewalls: int, seed: int) -> dict:
+    """
+    Write a nebula-files tree under `root` and return a config.yml-style dict of hosts and lighthouses.
+    """
+    rng = random.Random(seed)
+    configs = root / 'configs'
+    base_rules = [{'port': 'any', 'proto': 'icmp', 'host': 'any'}]
+    write_yaml(configs / 'base' / 'base.yaml', {
+        'pki': {'ca': '/etc/nebula/ca.crt', 'cert': '/etc/nebula/host.crt', 'key': '/etc/nebula/host.key'},
+        'listen': {'host': '0.0.0.0', 'port': 4242},
+        'punchy': {'punch': True},
+        'tun': {'dev': 'nebula1', 'mtu': 1300},
+        'logging': {'level': 'info', 'format': 'text'},
+        'firewall': {'conntrack': {'tcp_timeout': '12m'}, 'outbound': [{'port': 'any', 'proto': 'any', 'host': 'any'}], 'inbound': list(base_rules)},
+    })
+    write_yaml(configs / 'base' / 'default.yaml', {})
+    write_yaml(configs / 'base' / 'host-base.yaml', {'lighthouse': {'am_lighthouse': False, 'hosts': ['10.0.0.1']}})
+    write_yaml(configs / 'base' / 'lighthouse-base.yaml', {'lighthouse': {'am_lighthouse': True}})
+
+    group_names = [f'group{i}' for i in range(groups)]
+    for i in range(firewalls):
+        write_yaml(configs / 'firewall' / f'firewall{i}.yaml', {
+            g: {'inbound': [{'port': rng.choice([22, 80, 443, 8000 + rng.randrange(100)]), 'proto': rng.choice(['tcp', 'udp']), 'group': rng.choice(group_names)} for _ in range(rng.randint(1, 6))]}
+            for g in rng.sample(group_names, min(groups, rng.randint(1, 4)))
+        })
+    for i in range(extras):
+        write_yaml(configs / 'extra' / f'extra{i}.yaml', {
+            'groups': rng.sample(group_names, min(groups, rng.randint(1, 3))),
+            'extra': {'preferred_ranges': [f'192.168.{i}.0/24'], 'punchy': {'delay': f'{rng.randint(1, 5)}s'}},
+        })
+    for i in range(overrides):
+        write_yaml(configs / 'override' / f'override{i}.yaml', {'logging': {'level': rng.choice(['debug', 'warning'])}})
+    for directory in ('firewall', 'extra', 'override'):
+        (configs / directory).mkdir(parents=True, exist_ok=True)
+
+    inventory = {'hosts': {}, 'lighthouses': {}}
+    for i in range(hosts):
+        ip = f'10.{(i >> 16) & 255}.{(i >> 8) & 255}.{(i & 255) or 1}'
+        host = {'nebula_ip': ip, 'groups': sorted(rng.sample(group_names, min(groups, rng.randint(1, 4))))}
+        if overrides and rng.random() < 0.1:
+            host['overrides'] = [f'override{rng.randrange(overrides)}']
+        kind = 'lighthouses' if i < max(1, hosts // 100) else 'hosts'
+        inventory[kind][f'host{i}'] = host
+    return inventory
+
+
+def host_items(inventory: dict) -> list:
+    return [(hostname, host, 'host') for hostname, host in inventory['hosts'].items()] + [(hostname, host, 'lighthouse') for hostname, host in inventory['lighthouses'].items()]
+
+
+def measure(fn, repeat: int, memory: bool) -> dict:
+    """
+    Run `fn` `repeat` times. Returns the min and median seconds and, with `memory`, the peak traced allocation.
+    """
+    times = []
+    peak = None
+    for _ in range(repeat):
+        if memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+        if memory:
+            peak = max(peak or 0, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+    return {'min': min(times), 'median': statistics.median(times), 'peak_mb': peak / 1e6 if peak is not None else None}
+
+
+def run(n: int, args, work: Path) -> list:
+    root = work / f'fleet-{n}'
+    inventory = generate_inventory(root, n, args.groups, args.extras, args.overrides, args.firewalls, args.seed)
+    paths = NebulaPaths(root)
+    items = host_items(inventory)
+    results = []
+
+    def record(name, fn, repeat=args.repeat):
+        x = measure(fn, repeat, args.memory)
+        results.append({'benchmark': name, 'hosts': n, **x, 'per_host_ms': x['min'] / n * 1000})
+        print(f'{n:>6} hosts | {name:<16} | {x["min"]:.3f}s min | {x["median"]:.3f}s median' + (f' | {x["peak_mb"]:.1f} MB peak' if args.memory else ''))
+
+    record('template_load', lambda: HostBuilder(paths))
+
+    def build_all():
+        builder = HostBuilder(paths)
+        for hostname, host, type in items:
+            builder.build_config(hostname, builder.base, builder.lighthouse_base if type == 'lighthouse' else builder.host_base, host)
+
+    record('build_config', build_all)
+
+    builder = HostBuilder(paths)
+    built = [builder.build_config(hostname, builder.base, builder.lighthouse_base if type == 'lighthouse' else builder.host_base, host) for hostname, host, type in items]
+    record('yaml_dump', lambda: [dump_config(x) for x in built])
+    record('render_serial', lambda: list(render_configs(HostBuilder(paths), items, workers=1)))
+    record('render_parallel', lambda: list(render_configs(HostBuilder(paths), items)))
+
+    # Cert signing runs the stub once per cert, so it's only repeated once.
+    certs_dir = root / 'certs'
+    certs_dir.mkdir()
+    stub = root / 'nebula-cert'
+    stub.write_text(stub_nebula_cert)
+    stub.chmod(0o755)
+    (root / 'ca.crt').write_text(stub_ca_crt)
+    (root / 'ca.key').write_text('CA KEY')
+    certs = NebulaCerts(ca_cert=root / 'ca.crt', ca_key=root / 'ca.key', out_dir=certs_dir, subnet_size=8, nebula_exe_path=stub)
+    to_sign = [{'name': hostname, 'type': type, 'ip': host['nebula_ip'], 'groups': host['groups']} for hostname, host, type in items]
+
+    def sign_all():
+        if len(certs.sign_batch(to_sign)):
+            raise RuntimeError('The stub nebula-cert failed to sign some certs')
+
+    record('cert_sign', sign_all, repeat=1)
+
+    # A payload the size of a real Nebula release, random so it doesn't compress away.
+    payload = root / 'payload.gz'
+    rng = random.Random(args.seed)
+    with open(payload, 'wb') as out, gzip.GzipFile(fileobj=out, mode='wb', mtime=0) as gz:
+        gz.write(tar_member('nebula/nebula', rng.randbytes(args.payload_mb * 1000 * 1000), mode=0o755))
+    sfx_dir = root / 'sfx'
+    sfx_dir.mkdir()
+    config = dump_config(built[0])
+    jobs = [{'hostname': hostname, 'output': sfx_dir, 'config': config, 'host_key': 'KEY', 'host_crt': 'CRT', 'ca_crt': 'CA', 'payload': payload, 'init_type': 'systemd', 'arch': 'linux-amd64'} for hostname, _, _ in items]
+
+    def build_all_installers():
+        errors = [error for _, _, _, error in build_installers(jobs) if error]
+        if len(errors):
+            raise RuntimeError(f'Failed to build {len(errors)} installers: {errors[0]}')
+
+    record('sfx_build', build_all_installers, repeat=1)
+
+    shutil.rmtree(root)
+    return results
+
+
+def git_revision() -> str:
+    s = subprocess.run(['git', '-C', str(repo), 'rev-parse', 'HEAD'], capture_output=True, text=True)
+    return s.stdout.strip() if s.returncode == 0 else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark nebula-distributor against synthetic fleets.')
+    parser.add_argument('--hosts', type=int, nargs='+', default=[100, 1000], help='Fleet sizes to run.')
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--extras', type=int, default=10)
+    parser.add_argument('--overrides', type=int, default=5)
+    parser.add_argument('--firewalls', type=int, default=10)
+    parser.add_argument('--payload-mb', type=int, default=15, help='Size of the fake Nebula binaries in the installers.')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--memory', action='store_true', help='Trace peak memory too. Makes everything a lot slower.')
+    parser.add_argument('--output', default=None, help='Write the results to this JSON file.')
+    args = parser.parse_args()
+
+    work = Path(tempfile.mkdtemp(prefix='nebula-distributor-bench-'))
+    try:
+        results = [x for n in args.hosts for x in run(n, args, work)]
+    finally:
+        shutil.rmtree(work)
+
+    report = {
+        'meta': {
+            'time': datetime.now(timezone.utc).isoformat(),
+            'git': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'params': {k: v for k, v in vars(args).items() if k != 'output'},
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+"""
+Roll out to a fleet of fake SSH servers on this machine and measure how fast it goes.
+
+    ./scripts/loadtest.py --hosts 200 --parallel 1 16 64 --latency 0.05 --flaky 0.02 --drop 0.01 --output load.json
+
+Every host is a paramiko server on its own loopback address (127.1.x.y) that runs the commands it gets with sh,
+with /etc/nebula and the upload dirs moved under a per-host dir and `service`, `pidof`, `ip` and `nebula` stubbed.
+Faults are injected at random: slow commands, refused logins, commands that exit 1 and connections that drop in the
+middle of a command. distributor.py runs unchanged against the fleet with a throwaway HOME holding the only key the
+servers accept, and the results come from its --report and from what the servers saw.
+"""
+import argparse
+import getpass
+import json
+import logging
+import os
+import platform
+import posixpath
+import random
+import re
+import selectors
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import paramiko
+import yaml
+
+repo = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(repo))
+
+from benchmark import generate_inventory, git_revision, stub_ca_crt, stub_nebula_cert  # noqa: E402
+from nebula_distributor.tracing import percentile  # noqa: E402
+
+deploy_phases = ('connect', 'install', 'verify', 'reload', 'ready')
+
+# What the fake hosts run instead of the real thing. `ip` reports the host's Nebula IP so the readiness check passes.
+stub_commands = {
+    'service': '#!/bin/sh\nexit 0\n',
+    'pidof': '#!/bin/sh\necho 1\n',
+    'nebula': '#!/bin/sh\nexit 0\n',
+    'ip': '#!/bin/sh\necho "    inet $NEBULA_IP/8 scope global nebula1"\n',
+    'hostname': '#!/bin/sh\necho "$FAKE_HOSTNAME"\n',
+}
+
+# Remote paths that are moved under the host's own dir.
+remapped_paths = ('/etc/nebula', '/tmp/nebula-distributor-')
+
+
+class FakeHost:
+    def __init__(self, hostname: str, ip: str, root: Path):
+        self.hostname = hostname
+        self.ip = ip
+        self.root = root
+        (root / 'tmp').mkdir(parents=True, exist_ok=True)
+        (root / 'etc').mkdir(parents=True, exist_ok=True)
+        self.failed_commands = set()  # commands whose last run failed, to spot retries
+        self.counts = dict.fromkeys(('logins', 'auth_failures', 'commands', 'retries', 'flaky', 'dropped'), 0)
+
+    def rewrite(self, command: str) -> str:
+        command = re.sub(r"\bsudo (-S -p '[^']*' )?(-H -u \S+ )?", '', command)
+        # One pass, the host's own dir may well be under /tmp/nebula-distributor-* too.
+        return re.sub('|'.join(re.escape(x) for x in remapped_paths), lambda m: f'{self.root}{m.group(0)}', command)
+
+    def unrewrite(self, output: bytes) -> bytes:
+        return output.replace(str(self.root).encode(), b'')
+
+
+class Fleet:
+    """
+    The fake hosts and the faults to inject. All of them are served from one thread that accepts connections, each
+    connection then gets paramiko's transport thread and a thread per command.
+    """
+
+    def __init__(self, root: Path, bin_dir: Path, host_key: paramiko.PKey, client_key: paramiko.PKey, port: int, latency: float = 0,
+                 jitter: float = 0.5, auth_failures: float = 0, flaky: float = 0, drop: float = 0, seed: int = 1):
+        self.root = root
+        self.bin_dir = bin_dir
+        self.host_key = host_key
+        self.client_key = client_key
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.auth_failures = auth_failures
+        self.flaky = flaky
+        self.drop = drop
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.listeners = []
+        self.selector = selectors.DefaultSelector()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add_host(self, hostname: str, ip: str) -> FakeHost:
+        host = FakeHost(hostname, ip, self.root / hostname)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((ip, self.port))
+        sock.listen(64)
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, host)
+        self.listeners.append(sock)
+        self.hosts[hostname] = host
+        return host
+
+    def chance(self, p: float) -> bool:
+        with self.lock:
+            return self.rng.random() < p
+
+    def delay(self):
+        if self.latency:
+            with self.lock:
+                x = self.latency * (1 + self.rng.uniform(-self.jitter, self.jitter))
+            time.sleep(x)
+
+    def count(self, host: FakeHost, name: str):
+        with self.lock:
+            host.counts[name] += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.accept_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        for sock in self.listeners:
+            self.selector.unregister(sock)
+            sock.close()
+
+    def reset_counts(self):
+        for host in self.hosts.values():
+            host.counts = dict.fromkeys(host.counts, 0)
+            host.failed_commands.clear()
+
+    def accept_loop(self):
+        while not self.stopped.is_set():
+            for key, _ in self.selector.select(timeout=0.2):
+                try:
+                    sock, _ = key.fileobj.accept()
+                except BlockingIOError:
+                    continue
+                sock.setblocking(True)
+                threading.Thread(target=self.serve, args=(sock, key.data), daemon=True).start()
+
+    def serve(self, sock: socket.socket, host: FakeHost):
+        self.delay()
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, FakeSFTP)
+        try:
+            transport.start_server(server=FakeServer(self, host, transport))
+        except (paramiko.SSHException, EOFError, OSError):
+            # The distributor's reachability probe connects and hangs up straight away.
+            transport.close()
+
+    def run_command(self, host: FakeHost, transport: paramiko.Transport, channel: paramiko.Channel, command: str):
+        self.count(host, 'commands')
+        with self.lock:
+            if command in host.failed_commands:
+                host.counts['retries'] += 1
+        self.delay()
+        if self.chance(self.drop):
+            self.count(host, 'dropped')
+            with self.lock:
+                host.failed_commands.add(command)
+            transport.close()
+            return
+        if self.chance(self.flaky):
+            self.count(host, 'flaky')
+            with self.lock:
+                host.failed_commands.add(command)
+            channel.sendall_stderr(b'injected failure\n')
+            channel.send_exit_status(1)
+            channel.close()
+            return
+        env = {
+            'PATH': f'{self.bin_dir}:/usr/sbin:/usr/bin:/sbin:/bin',
+            'HOME': str(host.root),
+            'NEBULA_IP': host.ip,
+            'FAKE_HOSTNAME': host.hostname,
+        }
+        s = subprocess.run(['sh', '-c', host.rewrite(command)], stdin=subprocess.DEVNULL, capture_output=True, env=env)
+        with self.lock:
+            if s.returncode:
+                host.failed_commands.add(command)
+            else:
+                host.failed_commands.discard(command)
+        try:
+            channel.sendall(host.unrewrite(s.stdout))
+            channel.sendall_stderr(host.unrewrite(s.stderr))
+            channel.send_exit_status(s.returncode)
+            channel.close()
+        except (OSError, EOFError, paramiko.SSHException):
+            pass  # the client went away
+
+
+class FakeServer(paramiko.ServerInterface):
+    def __init__(self, fleet: Fleet, host: FakeHost, transport: paramiko.Transport):
+        self.fleet = fleet
+        self.host = host
+        self.transport = transport
+        self.refuse = fleet.chance(fleet.auth_failures)
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        if key.get_base64() != self.fleet.client_key.get_base64():
+            return paramiko.AUTH_FAILED
+        if self.refuse:
+            self.fleet.count(self.host, 'auth_failures')
+            return paramiko.AUTH_FAILED
+        self.fleet.count(self.host, 'logins')
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_none(self, username):
+        return paramiko.AUTH_FAILED
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_env_request(self, channel, name, value):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.fleet.run_command, args=(self.host, self.transport, channel, command.decode()), daemon=True).start()
+        return True
+
+
+class FakeSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+class FakeSFTP(paramiko.SFTPServerInterface):
+    """
+    SFTP into the host's dir.
+    """
+
+    def __init__(self, server: FakeServer, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = str(server.host.root)
+
+    def canonicalize(self, path):
+        return posixpath.normpath('/' + path)
+
+    def local(self, path) -> str:
+        return self.root + self.canonicalize(path)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self.local(path), flags, attr.st_mode if attr.st_mode is not None else 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = FakeSFTPHandle(flags)
+        handle.filename = self.local(path)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self.local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def list_folder(self, path):
+        try:
+            local = self.local(path)
+            return [paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(local, x)), x) for x in os.listdir(local)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self.local(path), attr.st_mode if attr.st_mode is not None else 0o755)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self.local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def remove(self, path):
+        try:
+            os.remove(self.local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self.local(oldpath), self.local(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK
+
+
+def fake_ip(i: int) -> str:
+    return f'127.1.{i // 250}.{i % 250 + 1}'
+
+
+def write_executable(path: Path, content: str):
+    path.write_text(content)
+    path.chmod(0o755)
+
+
+def setup(work: Path, args) -> tuple:
+    """
+    Write the inventory, config.yml, the keys and the stub commands. Returns the config path and the fleet.
+    """
+    files = work / 'files'
+    inventory = generate_inventory(files, args.hosts, args.groups, args.extras, args.overrides, args.firewalls, args.seed)
+    for i, (hostname, host) in enumerate([*inventory['lighthouses'].items(), *inventory['hosts'].items()]):
+        host['nebula_ip'] = fake_ip(i)
+    for kind in ('hosts', 'lighthouses'):
+        for host in inventory[kind].values():
+            host['arch'] = 'none'
+            host['ssh'] = {'port': args.port}
+    # The lighthouse IPs in the generated host base don't exist here, point them at the real lighthouses.
+    host_base = files / 'configs' / 'base' / 'host-base.yaml'
+    host_base.write_text(yaml.safe_dump({'lighthouse': {'am_lighthouse': False, 'hosts': [x['nebula_ip'] for x in inventory['lighthouses'].values()]}}))
+
+    bin_dir = work / 'bin'
+    bin_dir.mkdir()
+    write_executable(bin_dir / 'nebula-cert', stub_nebula_cert)
+    for name, content in stub_commands.items():
+        write_executable(bin_dir / name, content)
+    (work / 'certs').mkdir()
+    (work / 'ca.crt').write_text(stub_ca_crt)
+    (work / 'ca.key').write_text('CA KEY')
+
+    home = work / 'home'
+    (home / '.ssh').mkdir(parents=True)
+    client_key = paramiko.RSAKey.generate(2048)
+    client_key.write_private_key_file(str(home / '.ssh' / 'id_rsa'))
+    (home / '.ssh' / 'id_rsa.pub').write_text(f'ssh-rsa {client_key.get_base64()} loadtest\n')
+
+    config = {
+        'ssh': {'username': getpass.getuser(), 'timeout': args.timeout, 'ask_sudo': False, 'keepalive': 30, 'max_idle': 300},
+        'subnet_prefix_size': 8,
+        'certs': {'ca_cert': str(work / 'ca.crt'), 'ca_key': str(work / 'ca.key'), 'output_dir': str(work / 'certs')},
+        'config_output_dir': str(work / 'generated-configs'),
+        'sfx_output_dir': str(work / 'sfx'),
+        'state_file': str(work / 'deploy-state.json'),
+        'ready_timeout': args.ready_timeout,
+        'rollout': {'canary': args.canary, 'wave_size': args.wave_size, 'max_failure_ratio': 1.0},
+        'hosts': inventory['hosts'],
+        'lighthouses': inventory['lighthouses'],
+    }
+    config_path = work / 'config.yml'
+    with open(config_path, 'w') as file:
+        yaml.safe_dump(config, file)
+
+    fleet = Fleet(work / 'fleet', bin_dir, paramiko.RSAKey.generate(2048), client_key, args.port, latency=args.latency, jitter=args.jitter,
+                  auth_failures=args.auth_failures, flaky=args.flaky, drop=args.drop, seed=args.seed)
+    for kind in ('lighthouses', 'hosts'):
+        for hostname, host in inventory[kind].items():
+            fleet.add_host(hostname, host['nebula_ip'])
+    return config_path, fleet
+
+
+def read_report(path: Path) -> tuple:
+    records = []
+    summary = {}
+    with open(path) as file:
+        for line in file:
+            x = json.loads(line)
+            if 'summary' in x:
+                summary = x['summary']
+            else:
+                records.append(x)
+    return records, summary
+
+
+def run(parallel: int, work: Path, config_path: Path, fleet: Fleet, args) -> dict:
+    fleet.reset_counts()
+    report = work / f'report-{parallel}.jsonl'
+    log = work / f'distributor-{parallel}.log'
+    cmd = [sys.executable, str(repo / 'distributor.py'), '--config', str(config_path), '--files', str(work / 'files'), '--generate-certs',
+           '--parallel', str(parallel), '--report', str(report), *args.distributor_args]
+    env = {k: v for k, v in os.environ.items() if k not in ('SSH_AUTH_SOCK', 'DISPLAY', 'SSH_ASKPASS')}
+    env['HOME'] = str(work / 'home')
+    env['PATH'] = f'{work / "bin"}:{env.get("PATH", "/usr/bin:/bin")}'
+    env['PYTHON_KEYRING_BACKEND'] = 'keyring.backends.null.Keyring'  # sudo isn't asked for, keep the real keystore out of it
+    start = time.perf_counter()
+    with open(log, 'w') as out:
+        # A new session without a terminal, so nothing (like ssh-copy-id after a refused login) can stop to ask.
+        s = subprocess.run(cmd, cwd=work, env=env, stdin=subprocess.DEVNULL, stdout=out, stderr=subprocess.STDOUT, start_new_session=True)
+    wall = time.perf_counter() - start
+    if s.returncode or not report.exists():
+        raise RuntimeError(f'distributor.py exited with {s.returncode}, see {log}')
+
+    records, summary = read_report(report)
+    deploys = {}
+    for x in records:
+        if x['phase'] in deploy_phases:
+            deploys.setdefault(x['host'], []).append(x)
+    latencies = [max(x['start'] + x['seconds'] for x in phases) - min(x['start'] for x in phases) for phases in deploys.values()]
+    ok = [host for host, phases in deploys.items() if all(x['ok'] for x in phases)]
+    rollout = 0
+    if len(deploys):
+        everything = [x for phases in deploys.values() for x in phases]
+        rollout = max(x['start'] + x['seconds'] for x in everything) - min(x['start'] for x in everything)
+
+    counts = dict.fromkeys(next(iter(fleet.hosts.values())).counts, 0)
+    for host in fleet.hosts.values():
+        for name, n in host.counts.items():
+            counts[name] += n
+    counts['reconnects'] = sum(max(0, x.counts['logins'] - 1) for x in fleet.hosts.values())
+
+    result = {
+        'hosts': len(fleet.hosts),
+        'parallel': parallel,
+        'ok': len(ok),
+        'failed': len(fleet.hosts) - len(ok),
+        'wall_seconds': wall,
+        'rollout_seconds': rollout,
+        'hosts_per_second': len(ok) / rollout if rollout else None,
+        'host_seconds': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies),
+        } if len(latencies) else None,
+        'server': counts,
+        'phases': summary,
+    }
+    if result['host_seconds']:
+        tail = f'p50 {result["host_seconds"]["p50"]:.2f}s | p95 {result["host_seconds"]["p95"]:.2f}s | p99 {result["host_seconds"]["p99"]:.2f}s'
+    else:
+        tail = 'no hosts deployed'
+    print(f'{len(fleet.hosts):>6} hosts | -p {parallel:<4} | {len(ok)} ok | {result["hosts_per_second"] or 0:.1f} hosts/s | {tail} | '
+          f'{counts["retries"]} retries | {counts["reconnects"]} reconnects')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Roll out to a fake SSH fleet on this machine and measure it.')
+    parser.add_argument('--hosts', type=int, default=50, help='Fleet size. Each host gets its own 127.1.x.y address.')
+    parser.add_argument('--parallel', type=int, nargs='+', default=[1, 16], help='Run the rollout once with each of these --parallel values.')
+    parser.add_argument('--port', type=int, default=2222, help='SSH port of the fake hosts.')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds every login and command takes on top of the actual work.')
+    parser.add_argument('--jitter', type=float, default=0.5, help='Vary the latency by up to this share either way.')
+    parser.add_argument('--auth-failures', type=float, default=0, help='Share of logins that are refused.')
+    parser.add_argument('--flaky', type=float, default=0, help='Share of commands that exit 1 without running.')
+    parser.add_argument('--drop', type=float, default=0, help='Share of commands during which the connection is dropped.')
+    parser.add_argument('--timeout', type=int, default=3, help='ssh.timeout in the generated config.yml.')
+    parser.add_argument('--ready-timeout', type=int, default=10)
+    parser.add_argument('--canary', type=int, default=1)
+    parser.add_argument('--wave-size', type=int, default=0)
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--extras', type=int, default=10)
+    parser.add_argument('--overrides', type=int, default=5)
+    parser.add_argument('--firewalls', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--keep', action='store_true', help='Keep the temp dir with the logs, reports and fake hosts.')
+    parser.add_argument('--output', default=None, help='Write the results to this JSON file.')
+    parser.add_argument('distributor_args', nargs=argparse.REMAINDER, help='Anything after -- is passed to distributor.py, like -- --transaction.')
+    args = parser.parse_args()
+    args.distributor_args = [x for x in args.distributor_args if x != '--']
+
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    work = Path(tempfile.mkdtemp(prefix='nebula-distributor-loadtest-'))
+    fleet = None
+    try:
+        config_path, fleet = setup(work, args)
+        fleet.start()
+        results = [run(parallel, work, config_path, fleet, args) for parallel in args.parallel]
+    finally:
+        fleet.stop() if fleet is not None else None
+        if args.keep:
+            print('Kept', work)
+        else:
+            shutil.rmtree(work)
+
+    report = {
+        'meta': {
+            'time': datetime.now(timezone.utc).isoformat(),
+            'git': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'params': {k: v for k, v in vars(args).items() if k not in ('output', 'keep')},
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Measure how long distributor.py takes to start and finish for runs that don't deploy anything, and which of the heavy
+dependencies each of them imports.
+
+    ./scripts/startup.py --repeat 10 --output startup.json
+    ./scripts/startup.py --distributor ../old-checkout/distributor.py
+
+Runs against a small generated inventory in a temp dir with a stub nebula-cert. `--ping` goes to loopback addresses
+nothing listens on and the installers are built without Nebula binaries, so nothing is downloaded.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import yaml
+
+repo = Path(__file__).absolute().parent.parent
+
+from benchmark import generate_inventory, git_revision, stub_ca_crt, stub_nebula_cert  # noqa: E402
+
+heavy_modules = ('fabric', 'paramiko', 'invoke', 'netifaces', 'keyring', 'requests', 'prometheus_client', 'inotify_simple')
+
+modes = {
+    'help': ['--help'],
+    'generate-only': ['--generate-only'],
+    'sfx-only': ['--generate-only', '--sfx'],
+    'ping': ['--ping'],
+}
+
+
+def setup(work: Path, hosts: int) -> Path:
+    files = work / 'files'
+    inventory = generate_inventory(files, hosts, groups=10, extras=5, overrides=2, firewalls=5, seed=1)
+    for i, host in enumerate([*inventory['lighthouses'].values(), *inventory['hosts'].values()]):
+        host['nebula_ip'] = f'127.1.{i // 250}.{i % 250 + 1}'
+        host['arch'] = 'none'
+    (work / 'bin').mkdir()
+    (work / 'bin' / 'nebula-cert').write_text(stub_nebula_cert)
+    (work / 'bin' / 'nebula-cert').chmod(0o755)
+    (work / 'certs').mkdir()
+    (work / 'ca.crt').write_text(stub_ca_crt)
+    (work / 'ca.key').write_text('CA KEY')
+    config = {
+        'ssh': {'username': 'nobody', 'timeout': 1, 'ask_sudo': False},
+        'subnet_prefix_size': 8,
+        'certs': {'ca_cert': str(work / 'ca.crt'), 'ca_key': str(work / 'ca.key'), 'output_dir': str(work / 'certs')},
+        'config_output_dir': str(work / 'generated-configs'),
+        'sfx_output_dir': str(work / 'sfx'),
+        'cache_dir': str(work / 'cache'),
+        'hosts': inventory['hosts'],
+        'lighthouses': inventory['lighthouses'],
+    }
+    config_path = work / 'config.yml'
+    with open(config_path, 'w') as file:
+        yaml.safe_dump(config, file)
+    return config_path
+
+
+def parse_importtime(stderr: str) -> tuple:
+    """
+    Total seconds spent importing and the top-level packages that were imported, from `python -X importtime`.
+    """
+    total = 0
+    packages = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):  # only the top-level imports, the rest is already in their cumulative time
+            total += int(cumulative) / 1e6
+        packages.add(name.strip().split('.')[0])
+    return total, packages
+
+
+def run(mode: str, cmd: list, env: dict, work: Path, repeat: int) -> dict:
+    subprocess.run(cmd, cwd=work, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)  # warm up, signs the certs
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        s = subprocess.run(cmd, cwd=work, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        times.append(time.perf_counter() - start)
+        if s.returncode:
+            raise RuntimeError(f'{mode} exited with {s.returncode}:\n{s.stderr}')
+    s = subprocess.run([sys.executable, '-X', 'importtime', *cmd[1:]], cwd=work, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    import_seconds, packages = parse_importtime(s.stderr)
+    heavy = [x for x in heavy_modules if x in packages]
+    print(f'{mode:<14} | {min(times):.3f}s min | {statistics.median(times):.3f}s median | {import_seconds:.3f}s importing | heavy: {", ".join(heavy) or "none"}')
+    return {'mode': mode, 'min': min(times), 'median': statistics.median(times), 'import_seconds': import_seconds, 'heavy_imports': heavy}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the startup time of distributor.py.')
+    parser.add_argument('--distributor', default=repo / 'distributor.py', help='The distributor.py to measure, e.g. from another checkout.')
+    parser.add_argument('--hosts', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--modes', nargs='+', default=list(modes), choices=list(modes))
+    parser.add_argument('--output', default=None, help='Write the results to this JSON file.')
+    args = parser.parse_args()
+
+    distributor = Path(args.distributor).absolute()
+    work = Path(tempfile.mkdtemp(prefix='nebula-distributor-startup-'))
+    env = {**os.environ, 'PATH': f'{work / "bin"}:{os.environ.get("PATH", "/usr/bin:/bin")}'}
+    try:
+        config_path = setup(work, args.hosts)
+        base = [sys.executable, str(distributor), '--config', str(config_path), '--files', str(work / 'files')]
+        results = [run(mode, base + modes[mode], env, work, args.repeat) for mode in args.modes]
+    finally:
+        shutil.rmtree(work)
+
+    report = {
+        'meta': {
+            'time': datetime.now(timezone.utc).isoformat(),
+            'git': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'params': {k: str(v) for k, v in vars(args).items() if k != 'output'},
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()